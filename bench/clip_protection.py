@@ -0,0 +1,109 @@
+"Clip protection scenarios and cost per meter packet, run with: python3 -m bench.clip_protection"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import argparse
+import struct
+import sys
+import time
+from lib.autogain import ClipProtection
+from lib.meters import METER_SCALE, Meters
+from lib.state import StateStore
+
+INPUTS = 16
+PACKET_INTERVAL = 0.05  # the mixer sends /meters every 50ms
+
+class Recorder:
+    "Stands in for the mixer client and the mixer state, keeps the gains sent"
+    def __init__(self):
+        self.name = ''
+        self.client = self
+        self.sent = []
+
+    def send(self, address, param=None):
+        self.sent.append((address, param))
+
+    def show_level(self, channel, bus, value):
+        pass
+
+def meter_blob(levels):
+    "A /meters/2 blob with the input levels in dB."
+    values = [round(level * METER_SCALE) for level in levels]
+    return struct.pack('<L%dh' % len(values), len(values), *values)
+
+def setup(gains):
+    "Protection for all inputs with the headamp gains given."
+    store = StateStore()
+    channels = {index: store.channel('/headamp/%02d' % (index + 1)) for index in range(INPUTS)}
+    for index, channel in channels.items():
+        channel.set_level(0, gains[index])
+    recorder = Recorder()
+    protection = ClipProtection(recorder, recorder, channels, threshold=-3.0, attack=0.1,
+                                release=1.0, step=1.0)
+    return protection, channels, recorder
+
+def play(protection, level, seconds, now):
+    "Feed seconds of meter packets with every input at level, returns the time after."
+    meters = Meters()
+    blob = meter_blob([level] * INPUTS)
+    for _ in range(int(seconds / PACKET_INTERVAL)):
+        protection.update(meters.received(2, blob), now)
+        now += PACKET_INTERVAL
+    return now
+
+def check(label, passed):
+    print('%-48s %s' % (label, 'ok' if passed else 'FAILED'))
+    return passed
+
+def scenarios():
+    "Run the scenarios, returns True if all passed."
+    passed = True
+    # a clipping input whose gain is already at the lowest setting, e.g. a line source
+    protection, channels, recorder = setup([0.0] * INPUTS)
+    now = play(protection, 0.0, 1.0, 0.0)
+    now = play(protection, -40.0, 2.0, now)
+    passed &= check('gain at the floor is left alone',
+                    not recorder.sent and not protection.restore and
+                    all(channel.get_level(0) == 0.0 for channel in channels.values()))
+    # an input at the floor does not keep the others from being protected
+    protection, channels, recorder = setup([0.0] + [0.5] * (INPUTS - 1))
+    now = play(protection, 0.0, 2.0, 0.0)
+    passed &= check('inputs next to one at the floor are lowered',
+                    channels[0].get_level(0) == 0.0 and
+                    all(channels[index].get_level(0) < 0.5 for index in range(1, INPUTS)))
+    # clipping inputs are lowered and raised back to where they were once they are quiet
+    protection, channels, recorder = setup([0.5] * INPUTS)
+    now = play(protection, 0.0, 2.0, 0.0)
+    passed &= check('clipping inputs are lowered',
+                    all(channel.get_level(0) < 0.5 for channel in channels.values()))
+    now = play(protection, -40.0, 30.0, now)
+    passed &= check('quiet inputs are raised back to their gain',
+                    not protection.restore and
+                    all(abs(channel.get_level(0) - 0.5) < 1e-9 for channel in channels.values()))
+    return passed
+
+def cost(count):
+    "Time update for quiet and clipping packets."
+    for label, level in (('quiet', -40.0), ('clipping', 0.0)):
+        protection, _, _ = setup([0.5] * INPUTS)
+        meters = Meters()
+        blob = meter_blob([level] * INPUTS)
+        bank = meters.received(2, blob)
+        now = 0.0
+        start = time.perf_counter()
+        for _ in range(count):
+            bank.update(bank.current)
+            protection.update(bank, now)
+            now += PACKET_INTERVAL
+        per_packet = (time.perf_counter() - start) / count
+        print('%-10s %8.1f us/packet' % (label, per_packet * 1e6))
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Check and time the clip protection.')
+    PARSER.add_argument('-n', '--packets', help='meter packets to time', type=int, default=2000)
+    ARGS = PARSER.parse_args()
+    OK = scenarios()
+    cost(ARGS.packets)
+    sys.exit(0 if OK else 1)
@@ -0,0 +1,270 @@
+"End to end latency benchmark, run with: python3 -m bench.latency"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import argparse
+import asyncio
+import subprocess
+import sys
+import threading
+import time
+from mido import Message
+import lib.midicontroller
+from lib.mixerstate import BUTTON_MUTE, MixerState
+from lib.simulator import MixerSimulator
+
+CONFIGS = ['peterdikant.json', 'rossdickson.json', 'simple.json']
+PORT_NAME = 'X-Touch Mini Bench'
+
+class LoopbackPort:
+    "In process stand in for a MIDI port when no virtual ports are available"
+    closed = False
+
+    def __init__(self, name, on_send=None):
+        self.name = name
+        self.on_send = on_send
+        self.callback = None
+
+    def send(self, msg):
+        self.on_send(msg)
+
+    def close(self):
+        self.closed = True
+
+class Surface:
+    """
+    The benchmark side of the X-Touch: injects MIDI into the app and time
+    stamps the LED messages coming back. Uses virtual MIDI ports if the
+    backend supports them, otherwise patches in loopback ports.
+    """
+    def __init__(self, on_led):
+        self.on_led = on_led
+        self.virtual = None
+        self.loopback_in = None
+        try:
+            from mido import open_input, open_output
+            self.virtual = open_output(PORT_NAME, virtual=True)
+            self.receiver = open_input(PORT_NAME, virtual=True,
+                                       callback=lambda msg: self.on_led(time.perf_counter(), msg))
+            self.mode = 'virtual MIDI ports'
+        except Exception:
+            self.virtual = None
+            self.mode = 'loopback ports'
+            names = lambda: [PORT_NAME]
+            lib.midicontroller.get_input_names = names
+            lib.midicontroller.get_output_names = names
+            lib.midicontroller.open_input = self.open_loopback_input
+            lib.midicontroller.open_output = lambda name: LoopbackPort(
+                name, lambda msg: self.on_led(time.perf_counter(), msg))
+
+    def open_loopback_input(self, name):
+        self.loopback_in = LoopbackPort(name)
+        return self.loopback_in
+
+    def ready(self, state):
+        "Check if the app is listening to MIDI input."
+        return bool(state.midi_controllers) and \
+            state.midi_controllers[0].inport.callback is not None
+
+    def inject(self, msg):
+        "Send a message from the surface, returns the time stamp."
+        stamp = time.perf_counter()
+        if self.virtual is not None:
+            self.virtual.send(msg)
+        else:
+            self.loopback_in.callback(msg)
+        return stamp
+
+    def close(self):
+        if self.virtual is not None:
+            self.virtual.close()
+            self.receiver.close()
+
+class BenchSimulator(MixerSimulator):
+    "Simulator that time stamps every datagram the app sends"
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.on_osc = None
+
+    def datagram_received(self, data, addr):
+        if self.on_osc is not None:
+            self.on_osc(time.perf_counter(), data)
+        super().datagram_received(data, addr)
+
+class Probe:
+    "Matches injected events to the output they cause"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pending = {}       # key -> list of injection time stamps
+        self.latencies = []
+
+    def expect(self, key, stamp):
+        with self.lock:
+            self.pending.setdefault(key, []).append(stamp)
+
+    def observed(self, key, stamp):
+        "Output for key seen, resolves every event still waiting for it."
+        with self.lock:
+            for injected in self.pending.pop(key, ()):
+                self.latencies.append(stamp - injected)
+
+    def report(self, label, events, duration):
+        "Print p50 / p99 / max latency and the throughput."
+        lost = sum(len(stamps) for stamps in self.pending.values())
+        if not self.latencies:
+            print('  %-10s no output observed (%d events)' % (label, events))
+            return
+        latencies = sorted(self.latencies)
+        def percentile(fraction):
+            return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+        print('  %-10s %6d events  p50 %7.2fms  p99 %7.2fms  max %7.2fms  %8.0f events/s%s' %
+              (label, events, percentile(0.5), percentile(0.99), latencies[-1] * 1000,
+               events / duration, '  %d unmatched' % lost if lost else ''))
+
+def osc_address(data):
+    "The address of an OSC datagram, without parsing the arguments."
+    return data[:data.index(b'\0')].decode()
+
+def storm_events(state, kind, count):
+    "The scripted control storm: (MIDI message, expected OSC address) pairs."
+    layer = state.midi_controllers[0].layer
+    controller = lib.midicontroller.MidiController
+    script = []
+    if kind == 'encoders':
+        encoders = [number for number, encoder in enumerate(layer.encoders)
+                    if encoder.channel is not None]
+        for i in range(count):
+            number = encoders[i % len(encoders)]
+            channel = layer.encoders[number].channel
+            # alternate direction so levels never pin at the end stops
+            value = 1 if (i // len(encoders)) % 2 == 0 else 65
+            script.append((Message('control_change', channel=controller.MC_CHANNEL,
+                                   control=controller.MIDI_ENCODER[number], value=value),
+                           channel.get_l_addr(layer.active_bus)))
+    elif kind == 'mutes':
+        buttons = [number for number, button in enumerate(layer.buttons)
+                   if button.op == BUTTON_MUTE]
+        for i in range(count):
+            number = buttons[i % len(buttons)]
+            channel = layer.buttons[number].channel
+            script.append((Message('note_on', channel=controller.MC_CHANNEL,
+                                   note=controller.MIDI_BUTTONS[number], velocity=127),
+                           channel.get_m_addr(layer.active_bus)))
+    return script
+
+def run_storm(surface, probe, script, interval):
+    "Inject the script from a thread, paced like a fast hand on the surface."
+    deadline = time.perf_counter()
+    for msg, address in script:
+        probe.expect(address, surface.inject(msg))
+        deadline += interval
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+async def bench_config(config, args):
+    "Run all storms against one config and print the results."
+    # run the simulator with its own loop on a thread so it does not share the app loop
+    sim_ready = threading.Event()
+    sim_loop = asyncio.new_event_loop()
+    sim_holder = {}
+    def serve():
+        asyncio.set_event_loop(sim_loop)
+        transport, protocol = sim_loop.run_until_complete(sim_loop.create_datagram_endpoint(
+            lambda: BenchSimulator(seed=1, signal='silence'), local_addr=('127.0.0.1', 0)))
+        sim_holder['transport'] = transport
+        sim_holder['simulator'] = protocol
+        sim_ready.set()
+        sim_loop.run_forever()
+        transport.close()
+    sim_thread = threading.Thread(target=serve, daemon=True)
+    sim_thread.start()
+    sim_ready.wait()
+    simulator = sim_holder['simulator']
+    sim_port = sim_holder['transport'].get_extra_info('sockname')[1]
+
+    osc_probe = Probe()
+    led_probe = Probe()
+    rings = {control: number for number, control in
+             enumerate(lib.midicontroller.MidiController.MIDI_RING)}
+    def on_led(stamp, msg):
+        if msg.type == 'control_change' and msg.control in rings:
+            led_probe.observed(rings[msg.control], stamp)
+    surface = Surface(on_led)
+    simulator.on_osc = lambda stamp, data: osc_probe.observed(osc_address(data), stamp)
+
+    state = MixerState(argparse.Namespace(debug=False, xair_address='127.0.0.1:%d' % sim_port,
+                                          monitor=False, clip=False, levels=False,
+                                          coalesce=args.coalesce, config_file=[config],
+                                          config_cache=False, layers=None,
+                                          metrics=None, metrics_interval=0, profile=None,
+                                          snapshot_dir=None, mixers=None, clip_threshold=-3.0,
+                                          clip_attack=0.1, clip_release=5.0, clip_step=1.0,
+                                          clip_inputs='1-16'))
+    print('%s (%s, coalesce %gms)' % (config, surface.mode, args.coalesce))
+
+    async def driver():
+        while not surface.ready(state):
+            if state.quit_called:
+                return
+            await asyncio.sleep(0.01)
+        loop = asyncio.get_running_loop()
+        interval = 1 / args.rate
+        for kind in ('encoders', 'mutes'):
+            script = storm_events(state, kind, args.events)
+            if not script:
+                continue
+            start = time.perf_counter()
+            await loop.run_in_executor(None, run_storm, surface, osc_probe, script, interval)
+            await asyncio.sleep(0.2)
+            osc_probe.report(kind, len(script), time.perf_counter() - start - 0.2)
+            osc_probe.reset()
+        # mixer side changes of the channels on the encoders, alternating so every change
+        # lights a different ring pattern
+        layer = state.midi_controllers[0].layer
+        shown = [(number, encoder.channel.get_l_addr(layer.active_bus))
+                 for number, encoder in enumerate(layer.encoders) if encoder.channel is not None]
+        start = time.perf_counter()
+        for i in range(args.events):
+            number, address = shown[i % len(shown)]
+            value = 0.2 if (i // len(shown)) % 2 == 0 else 0.8
+            led_probe.expect(number, time.perf_counter())
+            sim_loop.call_soon_threadsafe(simulator.set_value, address, value)
+            await asyncio.sleep(interval)
+        await asyncio.sleep(0.2)
+        led_probe.report('feedback', args.events, time.perf_counter() - start - 0.2)
+        state.shutdown()
+
+    try:
+        await asyncio.gather(state.run(), driver())
+    finally:
+        surface.close()
+        sim_loop.call_soon_threadsafe(sim_loop.stop)
+        sim_thread.join()
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description="""
+    Measure MIDI-in to OSC-out and OSC-in to LED-out latency by replaying
+    control storms against the simulator for each config.
+    """)
+    PARSER.add_argument('-c', '--config', help='config files to test (default all shipped)',
+                        nargs='*', default=CONFIGS)
+    PARSER.add_argument('-n', '--events', help='events per storm', type=int, default=2000)
+    PARSER.add_argument('-r', '--rate', help='events per second', type=float, default=1000.0)
+    PARSER.add_argument('-t', '--coalesce', help='encoder coalesce tick in ms', type=float,
+                        default=5.0)
+    ARGS = PARSER.parse_args()
+
+    if len(ARGS.config) > 1:
+        # one process per config so every run starts from a clean mixer state
+        for CONFIG in ARGS.config:
+            subprocess.run([sys.executable, '-m', 'bench.latency', '-c', CONFIG,
+                            '-n', str(ARGS.events), '-r', str(ARGS.rate),
+                            '-t', str(ARGS.coalesce)], check=False)
+    else:
+        asyncio.run(bench_config(ARGS.config[0], ARGS))
@@ -0,0 +1,51 @@
+"Micro-benchmark of OSC message encoding, run with: python3 -m bench.osc_send"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import argparse
+import socket
+import time
+from lib.xair import OSCClientServer
+
+# a typical encoder storm: levels on a few channels plus mute toggles
+MESSAGES = [('/ch/%02d/mix/fader' % (i % 16 + 1), (i % 100) / 100) for i in range(64)] + \
+    [('/ch/%02d/mix/on' % (i % 16 + 1), i % 2) for i in range(16)] + \
+    [('/ch/%02d/mix/%02d/level' % (i % 16 + 1, i % 10 + 1), 0.5) for i in range(16)]
+
+def run(label, encode, count, sink):
+    "Encode (and optionally send) count messages, return the time per message."
+    start = time.perf_counter()
+    for i in range(count):
+        address, value = MESSAGES[i % len(MESSAGES)]
+        dgram = encode(address, value)
+        if sink is not None:
+            sink.send(dgram)
+    per_message = (time.perf_counter() - start) / count
+    print('%-10s %8.0f ns/message %10.0f messages/s' % (label, per_message * 1e9, 1 / per_message))
+    return per_message
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Compare the OSC builder and template send paths.')
+    PARSER.add_argument('-n', '--count', help='messages per run', type=int, default=200000)
+    PARSER.add_argument('-s', '--send', help='also send each datagram to a local UDP socket',
+                        action='store_true')
+    ARGS = PARSER.parse_args()
+
+    SERVER = OSCClientServer(('127.0.0.1', 0), None)
+    SINK = None
+    if ARGS.send:
+        RECEIVER = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        RECEIVER.bind(('127.0.0.1', 0))
+        SINK = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        SINK.connect(RECEIVER.getsockname())
+
+    for ADDRESS, VALUE in MESSAGES + [('/xremotenfb', None)]:
+        if bytes(SERVER.encode_message(ADDRESS, VALUE)) != SERVER.build_message(ADDRESS, VALUE):
+            print('Error: template encoding of %s differs from the builder' % ADDRESS)
+            exit(1)
+
+    BUILDER = run('builder', SERVER.build_message, ARGS.count, SINK)
+    TEMPLATE = run('template', SERVER.encode_message, ARGS.count, SINK)
+    print('speedup    %8.1fx' % (BUILDER / TEMPLATE))
@@ -0,0 +1,145 @@
+"This module protects the mixer inputs from clipping by lowering the headamp gain"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+from collections import deque
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from lib.meters import METER_SCALE
+
+# headamp gain is sent as 0.0 - 1.0 for -12dB to +60dB
+GAIN_FLOOR_DB = -12.0
+GAIN_RANGE_DB = 72.0
+
+def parse_inputs(text):
+    "Parse a list of input numbers like 1-8,13-16 into meter indexes."
+    indexes = set()
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise ValueError('%s is not an input number or range' % part)
+        if first < 1 or last < first:
+            raise ValueError('%s is not an input number or range' % part)
+        indexes.update(range(first - 1, last))
+    return sorted(indexes)
+
+class ClipProtection:
+    """
+    Lowers the headamp gain of inputs that clip, driven by the /meters/2 input
+    levels of one mixer. An input whose level stays above the threshold for
+    the attack time loses a gain step, again after every attack time it stays
+    there. Once its held peak is well below the threshold and the release time
+    has passed since the last change, the gain is raised back a step, never
+    above where it was before the protection started. Changes are rate
+    limited over all inputs.
+    """
+    _MAX_CHANGES_PER_SECOND = 10
+    _RELEASE_MARGIN = 6.0   # dB below the threshold before the gain is raised again
+    _TOLERANCE = 1e-4       # level difference that means the gain was changed by hand
+
+    def __init__(self, state, mixer, channels, threshold=-3.0, attack=0.1, release=5.0,
+                 step=1.0):
+        self.state = state
+        self.mixer = mixer
+        self.channels = channels    # meter index -> headamp Channel
+        self.indexes = sorted(channels)
+        self.limit = threshold * METER_SCALE
+        self.release_limit = (threshold - self._RELEASE_MARGIN) * METER_SCALE
+        self.attack = attack
+        self.release = release
+        self.step = step / GAIN_RANGE_DB
+        self.over_since = {}    # meter index -> time the level went above the threshold
+        self.last_change = {}   # meter index -> time of the last gain change
+        self.restore = {}       # meter index -> gain before the protection lowered it
+        self.applied = {}       # meter index -> gain the protection set last
+        self.changes = deque()  # times of the changes in the last second
+        self.index_array = None
+        self.index_count = None
+
+    def hot(self, bank):
+        "The meter indexes of the protected inputs above the threshold in the last sample."
+        values = bank.current
+        count = min(len(values), bank.size)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            if self.index_count != count:
+                self.index_count = count
+                self.index_array = numpy.array([i for i in self.indexes if i < count],
+                                               dtype=numpy.intp)
+            return self.index_array[values[self.index_array] > self.limit].tolist()
+        limit = self.limit
+        return [i for i in self.indexes if i < count and values[i] > limit]
+
+    def update(self, bank, now):
+        "Called for every /meters/2 packet."
+        hot = self.hot(bank)
+        if not hot and not self.over_since and not self.restore:
+            return
+        for index in list(self.over_since):
+            if index not in hot:
+                del self.over_since[index]
+        attack = self.attack
+        due = []
+        for index in hot:
+            since = self.over_since.setdefault(index, now)
+            waiting = self.last_change.get(index, since)
+            if now - since >= attack and now - waiting >= attack:
+                due.append((waiting, index))
+        # the inputs that waited longest go first, so the rate limit can not starve any
+        due.sort()
+        for _, index in due:
+            self.change(index, -self.step, now, bank.peak(index))
+        for index in list(self.restore):
+            if index in self.over_since or index >= bank.size:
+                continue
+            if bank.peaks[index] < self.release_limit and \
+                    now - self.last_change.get(index, now) >= self.release:
+                self.change(index, self.step, now, bank.peak(index))
+
+    def change(self, index, delta, now, peak):
+        "Move the gain of an input by delta, unless the rate limit is reached."
+        changes = self.changes
+        while changes and now - changes[0] >= 1.0:
+            changes.popleft()
+        if len(changes) >= self._MAX_CHANGES_PER_SECOND:
+            return
+        channel = self.channels[index]
+        level = channel.get_level(0)
+        applied = self.applied.get(index)
+        if applied is not None and abs(level - applied) > self._TOLERANCE:
+            # the gain was set by hand since, that is the new reference
+            self.restore.pop(index, None)
+            del self.applied[index]
+            if delta > 0:
+                return
+        if delta < 0:
+            new_level = max(0.0, level + delta)
+            if new_level == level:
+                # already at the lowest gain, nothing to lower or to restore later
+                return
+            self.restore.setdefault(index, level)
+        elif index in self.restore:
+            new_level = min(self.restore[index], level + delta)
+        else:
+            return
+        if new_level == level:
+            return
+        changes.append(now)
+        self.last_change[index] = now
+        self.applied[index] = new_level
+        if delta > 0 and new_level >= self.restore[index]:
+            del self.restore[index]
+            del self.applied[index]
+        (address, param, LED) = channel.set_level(0, new_level)
+        self.mixer.client.send(address=address, param=param)
+        self.state.show_level(channel, 0, param)
+        print('Clip protection: %s%s %0.1fdB -> %0.1fdB, peak %0.1fdB' % (
+            self.mixer.name + ':' if self.mixer.name else '', address,
+            GAIN_FLOOR_DB + level * GAIN_RANGE_DB, GAIN_FLOOR_DB + new_level * GAIN_RANGE_DB,
+            peak))
@@ -0,0 +1,97 @@
+"This module runs the external commands of subprocess actions without blocking"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import asyncio
+import subprocess
+from collections import deque
+
+class CommandRunner:
+    """
+    Runs the commands of subprocess actions as child processes of the event
+    loop, at most `workers` at a time and each action one at a time. Pressing
+    an action again while it still waits replaces the waiting argument, a
+    command that runs longer than `timeout` seconds is killed.
+    """
+    def __init__(self, workers=2, timeout=5.0, queue_size=16):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.queue = deque()    # actions in the order they were pressed
+        self.waiting = {}       # action -> (argument, completion callback)
+        self.running = {}       # action -> task
+        # health counters
+        self.started = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def submit(self, proc, argument, on_done=None):
+        "Queue a command, returns False if the queue is full."
+        if proc in self.waiting:
+            self.waiting[proc] = (argument, on_done)
+            self.coalesced += 1
+            return True
+        if len(self.waiting) >= self.queue_size:
+            self.rejected += 1
+            print('Warning: Too many commands waiting, %s %s dropped' % (proc.proc_name, argument))
+            return False
+        self.waiting[proc] = (argument, on_done)
+        self.queue.append(proc)
+        self.start()
+        return True
+
+    def start(self):
+        "Start waiting commands while a worker is free."
+        for proc in list(self.queue):
+            if len(self.running) >= self.workers:
+                break
+            if proc in self.running:
+                continue
+            self.queue.remove(proc)
+            argument, on_done = self.waiting.pop(proc)
+            task = asyncio.ensure_future(self.run(proc, argument, on_done))
+            self.running[proc] = task
+            task.add_done_callback(lambda task, proc=proc: self.finished(proc))
+
+    def finished(self, proc):
+        self.running.pop(proc, None)
+        if self.queue:
+            self.start()
+
+    async def run(self, proc, argument, on_done):
+        "Run one command and report if it succeeded to the callback."
+        self.started += 1
+        success = False
+        try:
+            process = await asyncio.create_subprocess_exec(proc.proc_name, argument,
+                                                           stdin=subprocess.DEVNULL)
+        except OSError as error:
+            print('Warning: Can not run %s: %s' % (proc.proc_name, error))
+        else:
+            try:
+                success = await asyncio.wait_for(process.wait(), self.timeout) == 0
+            except asyncio.TimeoutError:
+                print('Warning: %s %s did not finish in %gs, killed' %
+                      (proc.proc_name, argument, self.timeout))
+            finally:
+                if process.returncode is None:
+                    process.kill()
+        if not success:
+            self.failed += 1
+        if on_done is not None:
+            on_done(proc, success)
+
+    def stop(self):
+        "Drop the waiting commands and kill the running ones."
+        self.queue.clear()
+        self.waiting.clear()
+        for task in list(self.running.values()):
+            task.cancel()
+
+    def health(self):
+        "One line summary of the health counters."
+        return 'commands: %d started, %d coalesced, %d failed, %d rejected' % (
+            self.started, self.coalesced, self.failed, self.rejected)
@@ -0,0 +1,83 @@
+"This module notices when an X-Touch Mini is unplugged or plugged in again"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+from mido import get_input_names
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+from lib.midicontroller import find_surfaces
+
+class SurfaceWatcher:
+    """
+    Closes the ports of surfaces that disappear and reattaches them when an
+    X-Touch Mini shows up again. On Linux with pyudev installed the sound
+    device events trigger a check, otherwise the MIDI ports are polled. The
+    poll only lists the input ports unless a surface is missing.
+    """
+    _POLL_INTERVAL = 1.0
+    _UDEV_POLL_INTERVAL = 30.0
+    _SETTLE = 0.5   # the MIDI ports show up a moment after the device event
+
+    def __init__(self, state):
+        self.state = state
+        self.scheduler = state.scheduler
+        self.monitor = None
+        self.poll = None
+        self.pending = None
+
+    def start(self):
+        "Watch with udev events if possible, the poll stays as a fallback."
+        interval = self._POLL_INTERVAL
+        if pyudev is not None:
+            try:
+                self.monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                self.monitor.filter_by('sound')
+                self.monitor.start()
+                self.scheduler.loop.add_reader(self.monitor.fileno(), self.device_event)
+                interval = self._UDEV_POLL_INTERVAL
+            except (OSError, ValueError) as error:
+                print('Warning: No udev events (%s), polling the MIDI ports' % error)
+                self.monitor = None
+        print('Monitoring X-Touch connection enabled')
+        self.poll = self.scheduler.every(interval, self.check)
+
+    def device_event(self):
+        "A sound device was added or removed, check the ports once they settled."
+        while self.monitor.poll(0) is not None:
+            pass
+        if self.pending is None:
+            self.pending = self.scheduler.after(self._SETTLE, self.check)
+
+    def check(self):
+        "Detach the surfaces that are gone and reattach the ones that came back."
+        self.pending = None
+        if self.state.quit_called:
+            return
+        controllers = self.state.midi_controllers
+        names = get_input_names()
+        for controller in controllers:
+            if controller.attached() and controller.input_name not in names:
+                controller.detach()
+        detached = [controller for controller in controllers if not controller.attached()]
+        if not detached:
+            return
+        in_use = {controller.input_name for controller in controllers if controller.attached()}
+        available = [pair for pair in find_surfaces() if pair[0] not in in_use]
+        for controller, (input_name, output_name) in zip(detached, available):
+            if controller.attach(input_name, output_name):
+                print('X-Touch %s reattached on layer %s' % (input_name,
+                                                             controller.current_layer))
+
+    def stop(self):
+        if self.monitor is not None:
+            self.scheduler.loop.remove_reader(self.monitor.fileno())
+            self.monitor = None
+        for timer in (self.poll, self.pending):
+            if timer is not None:
+                timer.cancel()
+        self.poll = None
+        self.pending = None
@@ -0,0 +1,142 @@
+"This module decodes and smooths the /meters data sent by the X-Air mixer"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import sys
+import struct
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# a meter value is a 16bit signed int mapped to -128db to 128db with 1/256 db
+# resolution, aka .004 dB, realistic values max at 0db
+METER_SCALE = 256
+METER_FLOOR = -128 * METER_SCALE
+
+def meter_source(addr):
+    """
+    The (bank, index) of the /meters value that shows the level of a channel
+    address, None if the mixer has no meter for it. Bank 1 has the 16 inputs,
+    the aux and fx returns as left/right pairs, the 6 buses, the 4 fx sends
+    and the main left/right, bank 2 the 16 inputs before the fader.
+    """
+    parts = addr.strip('/').split('/')
+    try:
+        if parts[0] == 'ch':
+            return (1, int(parts[1]) - 1)
+        if parts[0] == 'rtn':
+            return (1, 16 if parts[1] == 'aux' else 16 + 2 * int(parts[1]))
+        if parts[0] == 'bus':
+            return (1, 25 + int(parts[1]))
+        if parts[0] == 'fxsend':
+            return (1, 31 + int(parts[1]))
+        if parts[0] == 'lr':
+            return (1, 36)
+        if parts[0] == 'headamp':
+            return (2, int(parts[1]) - 1)
+    except (IndexError, ValueError):
+        pass
+    return None
+
+def decode_blob(blob):
+    """
+    Return a view of the values of a /meters blob: a little endian 32bit count
+    followed by the 16bit values. The view shares memory with the blob where the
+    host byte order allows it.
+    """
+    count = min(struct.unpack_from("<L", blob, 0)[0], (len(blob) - 4) // 2)
+    if numpy is not None:
+        return numpy.frombuffer(blob, dtype='<i2', count=count, offset=4)
+    if sys.byteorder == 'little':
+        return memoryview(blob)[4:4 + count * 2].cast('h')
+    values = array('h', blob[4:4 + count * 2])
+    values.byteswap()
+    return values
+
+class MeterBank:
+    """
+    Running average and peak hold of every value of one /meters/N bank.
+    The last `depth` samples are kept in a ring buffer indexed [channel, sample].
+    """
+    _DEPTH = 4      # 4 samples at 50ms, a .2 second running average
+    _HOLD = 20      # hold peaks for 1 second
+
+    def __init__(self, size, depth=_DEPTH, hold=_HOLD):
+        self.size = size
+        self.depth = depth
+        self.hold = hold
+        self.position = 0
+        if numpy is not None:
+            self.ring = numpy.full((size, depth), METER_FLOOR, dtype=numpy.int32)
+            self.sums = numpy.full(size, METER_FLOOR * depth, dtype=numpy.int32)
+            self.peaks = numpy.full(size, METER_FLOOR, dtype=numpy.int32)
+            self.ages = numpy.zeros(size, dtype=numpy.int32)
+            self.samples = numpy.zeros(size, dtype=numpy.int32)
+        else:
+            self.ring = array('i', [METER_FLOOR]) * (size * depth)
+            self.sums = array('i', [METER_FLOOR * depth]) * size
+            self.peaks = array('i', [METER_FLOOR]) * size
+            self.ages = array('i', [0]) * size
+        self.current = array('h')   # view of the last decoded values
+
+    def update(self, values):
+        "Push one sample of every channel into the ring buffer."
+        count = min(len(values), self.size)
+        position = self.position
+        if numpy is not None:
+            samples = self.samples[:count]
+            samples[:] = values[:count]
+            values = samples
+            self.sums[:count] += values - self.ring[:count, position]
+            self.ring[:count, position] = values
+            rising = values >= self.peaks[:count]
+            expired = self.ages[:count] >= self.hold
+            reset = rising | expired
+            self.ages[:count] += 1
+            self.ages[:count][reset] = 0
+            self.peaks[:count][reset] = values[reset]
+        else:
+            ring, sums, peaks, ages = self.ring, self.sums, self.peaks, self.ages
+            depth, hold = self.depth, self.hold
+            slot = position
+            for i in range(count):
+                value = values[i]
+                sums[i] += value - ring[slot]
+                ring[slot] = value
+                if value >= peaks[i] or ages[i] >= hold:
+                    peaks[i] = value
+                    ages[i] = 0
+                else:
+                    ages[i] += 1
+                slot += depth
+        self.position = (position + 1) % self.depth
+        self.current = values
+
+    def level(self, channel):
+        "Running average of a channel in dB."
+        return self.sums[channel] / (self.depth * METER_SCALE)
+
+    def peak(self, channel):
+        "Held peak of a channel in dB."
+        return self.peaks[channel] / METER_SCALE
+
+class Meters:
+    """
+    The meter banks received from the mixer, allocated on the first packet of
+    each bank and reused afterwards.
+    """
+    def __init__(self):
+        self.banks = {}
+
+    def received(self, bank, blob):
+        "Decode a /meters/N blob and update the bank, returns the bank."
+        values = decode_blob(blob)
+        meter_bank = self.banks.get(bank)
+        if meter_bank is None or meter_bank.size < len(values):
+            meter_bank = self.banks[bank] = MeterBank(len(values))
+        meter_bank.update(values)
+        return meter_bank
@@ -0,0 +1,173 @@
+"This module collects low overhead metrics of the hot paths"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import bisect
+import cProfile
+import signal
+import sys
+import time
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets from 1us to 10ms
+    """
+    BOUNDS = [1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        "Upper bound of the bucket holding the percentile, in seconds."
+        target = self.count * fraction
+        seen = 0
+        for index, number in enumerate(self.buckets):
+            seen += number
+            if seen >= target and number > 0:
+                return self.BOUNDS[index] if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return 'count 0'
+        return 'count %d mean %0.1fus p50 <%0.0fus p99 <%0.0fus max %0.0fus' % \
+            (self.count, self.total / self.count * 1e6, self.percentile(0.5) * 1e6,
+             self.percentile(0.99) * 1e6, self.max * 1e6)
+
+class Metrics:
+    """
+    Counters and latency histograms. Methods are instrumented by replacing them
+    with timed wrappers, so nothing is measured unless metrics are enabled.
+    """
+    def __init__(self, path, interval=60.0):
+        self.path = path
+        self.interval = interval
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+        self.timer = None
+        self.sources = []   # callables returning extra report lines
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def timed(self, name, function, size=None):
+        """
+        Wrap a function to record its latency, and with a size function that
+        maps the arguments to a byte count also the bytes passed through it.
+        """
+        histogram = self.histogram(name)
+        perf_counter = time.perf_counter
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.record(perf_counter() - start)
+                if size is not None:
+                    self.count(name + '.bytes', size(*args, **kwargs))
+        return wrapper
+
+    def instrument(self, obj, *methods):
+        "Replace methods of an object with timed wrappers named after them."
+        for method in methods:
+            setattr(obj, method, self.timed(method, getattr(obj, method)))
+
+    def classified(self, routes, handler):
+        "Wrap the OSC message handler to count messages by address class."
+        def wrapper(addr, *data):
+            route = routes.get(addr)
+            if route is not None:
+                self.count('osc_in.' + route.kind)
+            elif addr == '/xinfo' or addr.startswith('/-'):
+                self.count('osc_in.' + addr[1:6])
+            else:
+                self.count('osc_in.unknown')
+            return handler(addr, *data)
+        return wrapper
+
+    def report(self):
+        "The metrics as text, one line per counter or histogram."
+        lines = ['# xair-remote metrics at %s, uptime %0.1fs' %
+                 (time.strftime('%Y-%m-%d %H:%M:%S'), time.monotonic() - self.started)]
+        for name in sorted(self.counters):
+            lines.append('counter %s %d' % (name, self.counters[name]))
+        for name in sorted(self.histograms):
+            lines.append('latency %s %s' % (name, self.histograms[name].summary()))
+        for source in self.sources:
+            lines.extend(source())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        "Write the report to the metrics file, or stdout for '-'."
+        if self.path == '-':
+            sys.stdout.write(self.report())
+            return
+        try:
+            with open(self.path, 'w') as metrics_file:
+                metrics_file.write(self.report())
+        except OSError as error:
+            print('Error: Can not write metrics to %s: %s' % (self.path, error))
+
+    def start(self, scheduler):
+        "Dump on SIGUSR1 and every interval seconds."
+        add_signal(scheduler.loop, 'SIGUSR1', self.dump)
+        if self.interval > 0:
+            self.timer = scheduler.every(self.interval, self.dump)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.dump()
+
+class Profiler:
+    """
+    cProfile toggled with SIGUSR2, the stats are written when profiling stops
+    """
+    def __init__(self, path):
+        self.path = path
+        self.profile = None
+
+    def start(self, loop):
+        add_signal(loop, 'SIGUSR2', self.toggle)
+
+    def toggle(self):
+        if self.profile is None:
+            print('Profiling started')
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.stop()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            print('Profile written to %s' % self.path)
+            self.profile = None
+
+def add_signal(loop, name, callback):
+    "Install a signal handler on the loop where the platform supports it."
+    try:
+        loop.add_signal_handler(getattr(signal, name), callback)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        print('Warning: %s is not supported on this platform' % name)
@@ -4,56 +4,102 @@
 # Additions Copyright (c) 2021 Ross Dickson
 # Some rights reserved. See LICENSE.
 
-import threading
-import time
-import os
+import asyncio
+import copy
+import statistics
+from collections import deque
 from mido import Message, open_input, open_output, get_input_names, get_output_names
 
 class TempoDetector:
     """
-    Detect song tempo via a tap button
+    Detect song tempo via a tap button and blink the tap buttons on the beat.
+    The beats are timers on the shared scheduler at absolute deadlines, so the
+    blink stays in step with the delay time.
     """
     _MAX_TAP_DURATION = 3.0
-    current_tempo = 0.5
-    number = -1
+    _TAP_HISTORY = 8
+    _TAP_TOLERANCE = 0.25  # intervals further than this fraction from the median are outliers
+    _MIN_TEMPO = 0.05
 
     def __init__(self, state):
         self.state = state
-        self.midi_controller = state.midi_controller
-        self.last_tap = 0
-        self.tap_num = 0
-        self.tap_delta = 0
-        worker = threading.Thread(target = self.blink)
-        worker.daemon = True
-        worker.start()
+        self.scheduler = state.scheduler
+        self.current_tempo = 0.5
+        self.last_tap = None
+        self.intervals = deque(maxlen=self._TAP_HISTORY)
+        self.off = None
+        self.beat = self.scheduler.every(self.current_tempo, self.blink_on,
+                                         start=self.scheduler.time())
 
     def tap(self):
-        current_time = time.time()
-        if current_time - self.last_tap > self._MAX_TAP_DURATION:
+        current_time = self.scheduler.time()
+        if self.last_tap is None or current_time - self.last_tap > self._MAX_TAP_DURATION:
             # Start with new tap cycle
-            self.tap_num = 0
-            self.tap_delta = 0
+            self.intervals.clear()
         else:
-            self.tap_num += 1
-            self.tap_delta += current_time - self.last_tap
-            if self.tap_num > 0:
-                # Update tempo in mixer after at least 2 taps
-                self.state.update_tempo(self.tap_delta / self.tap_num)
-                self.current_tempo = self.tap_delta / self.tap_num
+            # Update tempo in mixer after at least 2 taps
+            self.intervals.append(current_time - self.last_tap)
+            tempo = self.estimate()
+            self.state.update_tempo(tempo)
+            self.set_tempo(tempo, current_time)
         self.last_tap = current_time
 
-    def blink(self):
-        try:
-            while self.state is not None and self.state.quit_called != True:
-                if self.number != -1:
-                    self.midi_controller.set_channel_mute(self.number, "On")
-                    time.sleep(self.current_tempo * 0.2)
-                    self.midi_controller.set_channel_mute(self.number, "Off")
-                    time.sleep(self.current_tempo * 0.8)
-        except KeyboardInterrupt:
-            if self.state is not None:
-                self.state.shutdown()
-            exit()
+    def estimate(self):
+        "Mean of the tap intervals near their median, so a missed or extra tap is ignored."
+        median = statistics.median(self.intervals)
+        kept = [interval for interval in self.intervals
+                if abs(interval - median) <= median * self._TAP_TOLERANCE]
+        return sum(kept) / len(kept) if kept else median
+
+    def set_tempo(self, tempo, beat=None):
+        "Blink at a new tempo, in phase with the beat at loop time beat if it is given."
+        if tempo < self._MIN_TEMPO:
+            return
+        self.current_tempo = tempo
+        if beat is None:
+            # the next beat keeps its time, the ones after it follow the new tempo
+            self.beat.period = tempo
+        else:
+            self.beat.cancel()
+            self.beat = self.scheduler.every(tempo, self.blink_on, start=beat + tempo)
+
+    def blink_on(self):
+        "Timer callback that lights the tap button at the start of a beat."
+        if self.state.quit_called:
+            return
+        if self.light("On"):
+            if self.off is not None:
+                self.off.cancel()
+            self.off = self.scheduler.at(self.beat.last + self.current_tempo * 0.2,
+                                         self.blink_off)
+
+    def blink_off(self):
+        "Timer callback that turns the tap button off for the rest of the beat."
+        self.off = None
+        if self.state.quit_called:
+            return
+        self.light("Off")
+
+    def light(self, LED):
+        "Set the tap button of every surface whose layer has one, False if none has."
+        lit = False
+        for controller in self.state.midi_controllers:
+            if controller.layer.tap_button != -1:
+                controller.set_channel_mute(controller.layer.tap_button, LED)
+                lit = True
+        return lit
+
+    def stop(self):
+        self.beat.cancel()
+        if self.off is not None:
+            self.off.cancel()
+            self.off = None
+
+def find_surfaces():
+    "Pair the input and output ports of every connected X-Touch Mini, in port order."
+    inputs = [name for name in get_input_names() if "x-touch mini" in name.lower()]
+    outputs = [name for name in get_output_names() if "x-touch mini" in name.lower()]
+    return list(zip(inputs, outputs))
 
 class MidiController:
     """
@@ -67,6 +113,13 @@ class MidiController:
     Buttons 9-16: Note 87, 88, 91, 92, 86, 93, 94, 95
     Buttons LA/LB (aka 17/18): Note 84/85
     Master Fader: Pitch Wheel
+
+    Every surface has its own copy of the layers, so it keeps its own
+    current layer and active bus, and its own frame of lit LEDs.
+
+    On a layer with meters the rings show the held meter peaks, redrawn at a
+    fixed frame rate, and the fader value for a moment after the encoder was
+    turned or pressed.
     """
     MC_CHANNEL = 0
 
@@ -79,140 +132,179 @@ class MidiController:
     LED_BLINK = 1
     LED_ON = 127
 
-    active_layer = 0
+    _METER_FPS = 15
+    _METER_RANGE = 60.0     # dB below 0dB shown on the ring
+    _TOUCH_HOLD = 1.0       # seconds the fader value is shown after a turn or press
 
     inport = None
     outport = None
 
-    def __init__(self, state):
+    def __init__(self, state, input_name, output_name, layer_name):
         self.state = state
+        self.loop = asyncio.get_running_loop()
+        self.layers = {name: copy.copy(layer) for name, layer in state.layers.items()}
+        self.current_layer = layer_name
+        self.layer = self.layers[layer_name]
+        self.input_name = input_name
+        self.output_name = output_name
+        self.started = False
+        # shadow frame of the values lit on the surface, None if unknown
+        self.lit_rings = [None] * len(self.MIDI_RING)
+        self.lit_buttons = [None] * len(self.MIDI_BUTTONS)
+        # values that differ from the lit frame, sent on the next flush
+        self.dirty_rings = {}
+        self.dirty_buttons = {}
+        self.flush_handle = None
+        # loop time each encoder was last turned or pressed
+        self.touched = [None] * len(self.MIDI_RING)
+        self.meter_timer = None
 
-        for name in get_input_names():
-            if "x-touch mini" in name.lower():
-                print('Using MIDI input: ' + name)
-                try:
-                    self.inport = open_input(name)
-                except IOError:
-                    print('Error: Can not open MIDI input port ' + name)
-                    self.state.quit_called = True
-                    self.state = None
-                    return
-                break
-
-        for name in get_output_names():
-            if "x-touch mini" in name.lower():
-                print('Using MIDI output: ' + name)
-                try:
-                    self.outport = open_output(name)
-                except IOError:
-                    print('Error: Can not open MIDI input port ' + name)
-                    self.state.quit_called = True
-                    self.state = None
-                    return
-                break
-
-        if self.inport is None or self.outport is None:
-            print('X-Touch Mini not found. Make sure device is connected!')
+        metrics = self.state.metrics
+        if metrics is not None:
+            metrics.instrument(self, 'set_ring', 'set_button')
+            self.midi_received = metrics.timed('midi_in', self.midi_received,
+                                               size=lambda msg: len(msg.bytes()))
+        if not self.open_ports(input_name, output_name):
             self.state.quit_called = True
-            self.cleanup_controller()
+            self.state = None
             return
 
         for i in range(0, 18):
             self.set_button(i, self.LED_OFF)    # clear all buttons
+        self.flush()
+
+    def open_ports(self, input_name, output_name):
+        "Open the MIDI ports of the surface, returns False if one can not be opened."
+        print('Using MIDI input: ' + input_name)
+        try:
+            self.inport = open_input(input_name)
+        except IOError:
+            print('Error: Can not open MIDI input port ' + input_name)
+            return False
+
+        print('Using MIDI output: ' + output_name)
+        try:
+            self.outport = open_output(output_name)
+        except IOError:
+            print('Error: Can not open MIDI output port ' + output_name)
+            self.inport.close()
+            self.inport = None
+            return False
+
+        metrics = self.state.metrics
+        if metrics is not None:
+            self.outport.send = metrics.timed('midi_out', self.outport.send,
+                                              size=lambda msg: len(msg.bytes()))
+        self.input_name = input_name
+        self.output_name = output_name
+        return True
 
-        worker = threading.Thread(target=self.midi_listener)
-        worker.daemon = True
-        worker.start()
+    def start(self):
+        "Start handling MIDI input on the event loop, once the mixer state is known."
+        # mido calls back on its own thread, hand each message over to the loop
+        self.inport.callback = lambda msg: self.loop.call_soon_threadsafe(self.midi_received, msg)
+        self.started = True
+        self.update_meters()
+
+    def attached(self):
+        return self.inport is not None
+
+    def detach(self):
+        "Close the ports of a surface that was unplugged, its layer and bus are kept."
+        print('X-Touch %s disconnected' % self.input_name)
+        for port in (self.inport, self.outport):
+            if port is not None:
+                try:
+                    port.close()
+                except (IOError, OSError):
+                    pass
+        self.inport = None
+        self.outport = None
 
-        if self.state.monitor:
-            print('Monitoring X-Touch connection enabled')
-            monitor = threading.Thread(target=self.monitor_ports)
-            monitor.daemon = True
-            monitor.start()
+    def attach(self, input_name, output_name):
+        """
+        Reopen a surface that was plugged in again and light it from the current
+        state. It starts dark, so only the LEDs that are on are sent, in one frame.
+        """
+        if not self.open_ports(input_name, output_name):
+            return False
+        self.lit_rings = [0] * len(self.MIDI_RING)
+        self.lit_buttons = [self.LED_OFF] * len(self.MIDI_BUTTONS)
+        self.dirty_rings.clear()
+        self.dirty_buttons.clear()
+        self.activate_bus()
+        if self.started:
+            self.start()
+        return True
 
     def cleanup_controller(self):
-        "Cleanup mixer state if we see a quit call. Called from _init_ or worker thread."
-        for i in range(0, 18):
-            self.set_button(i, self.LED_OFF)    # clear all buttons
-        for i in range(0,8):
-            self.set_ring(i,-1)
+        "Cleanup mixer state if we see a quit call. Called from _init_ or shutdown."
+        if self.meter_timer is not None:
+            self.meter_timer.cancel()
+            self.meter_timer = None
+        if self.outport is not None:
+            for i in range(0, 18):
+                self.set_button(i, self.LED_OFF)    # clear all buttons
+            for i in range(0,8):
+                self.set_lights(i, 0)
+            self.flush()
         if self.inport is not None:
             self.inport.close()
         if self.outport is not None:
             self.outport.close()
 
-    def monitor_ports(self):
-        "Method to exit if / when the X Touch disconnects"
-        try:
-            while not self.state.quit_called:
-                if self.inport.name not in get_input_names():
-                    print("X-Touch disconnected - Exiting")
-                    #os._exit(1)
-                    self.state.quit_called = True
-                    return
-                if self.state.quit_called:
-                    return # end the thread if other threads have signed exit
-                time.sleep(1)
-        except KeyboardInterrupt:
-            if self.state is not None:
-                self.state.shutdown()
-            else:
-                self.cleanup_controller()
-            exit()
+    def select_layer(self, layer_name, bus):
+        "Switch this surface to another layer."
+        self.current_layer = layer_name
+        self.layer = self.layers[layer_name]
+        self.layer.active_bus = bus
+        if self.started:
+            self.update_meters()
 
-    def midi_listener(self):
-        "Listen to midit inputs and respond."
-        try:
-            for msg in self.inport:
-                if self.state is None or self.state.quit_called:
-                    self.cleanup_controller()
-                    return
-                #print('Received {}'.format(msg))
-                if msg.type == 'control_change':
-                    if msg.control in self.MIDI_ENCODER:
-                        delta = msg.value
-                        if delta > 64:
-                            delta = (delta - 64) * -1
-                        encoder_num = self.MIDI_ENCODER.index(msg.control)
-                        LED = self.state.encoder_turn(encoder_num, delta)
-                        self.set_ring(encoder_num, LED)
-                    else:
-                        print('Received unknown {}'.format(msg))
-                elif msg.type == 'note_on' and msg.velocity == 127:
-                    if self.state.debug:
-                        print('Note {} pushed'.format(msg.note))
-                    if msg.note in self.MIDI_PUSH:
-                        encoder_num = self.MIDI_PUSH.index(msg.note)
-                        LED = self.state.encoder_press(encoder_num)
-                        self.set_ring(encoder_num, LED)
-                    elif msg.note in self.MIDI_BUTTONS:
-                        button_num = self.MIDI_BUTTONS.index(msg.note)
-                        LED = self.state.button_press(button_num)
-                        self.set_channel_mute(button_num, LED)
-                    else:
-                        print('Received unknown {}'.format(msg))
-                elif msg.type == 'pitchwheel':
-                    self.state.fader_move(msg)
-                elif msg.type != 'note_off' and msg.type != 'note_on':
-                    print('Received unknown {}'.format(msg))
-                if self.state.quit_called:
-                    self.state.shutdown()
-                    return
-        except KeyboardInterrupt:
-            if self.state is not None:
-                self.state.shutdown()
+    def midi_received(self, msg):
+        "Respond to a midi input, called on the event loop."
+        if self.state is None or self.state.quit_called:
+            return
+        #print('Received {}'.format(msg))
+        if msg.type == 'control_change':
+            if msg.control in self.MIDI_ENCODER:
+                delta = msg.value
+                if delta > 64:
+                    delta = (delta - 64) * -1
+                encoder_num = self.MIDI_ENCODER.index(msg.control)
+                self.touched[encoder_num] = self.loop.time()
+                LED = self.state.encoder_turn(self, encoder_num, delta)
+                self.set_ring(encoder_num, LED)
+            else:
+                print('Received unknown {}'.format(msg))
+        elif msg.type == 'note_on' and msg.velocity == 127:
+            if self.state.debug:
+                print('Note {} pushed'.format(msg.note))
+            if msg.note in self.MIDI_PUSH:
+                encoder_num = self.MIDI_PUSH.index(msg.note)
+                self.touched[encoder_num] = self.loop.time()
+                LED = self.state.encoder_press(self, encoder_num)
+                self.set_ring(encoder_num, LED)
+            elif msg.note in self.MIDI_BUTTONS:
+                button_num = self.MIDI_BUTTONS.index(msg.note)
+                LED = self.state.button_press(self, button_num)
+                if not self.state.quit_called:
+                    self.set_channel_mute(button_num, LED)
             else:
-                self.cleanup_controller()
-            exit()
+                print('Received unknown {}'.format(msg))
+        elif msg.type == 'pitchwheel':
+            self.state.fader_move(self, msg)
+        elif msg.type != 'note_off' and msg.type != 'note_on':
+            print('Received unknown {}'.format(msg))
 
     def activate_bus(self):
-        "refresh the lights for the current layer"
+        "refresh the lights for the current layer, only the differences are sent"
         # reset lights
         for i in range(0, 8):
-            self.set_ring(i, self.state.get_encoder(i))
-            self.set_channel_mute(i, self.state.get_button(i))
+            self.set_ring(i, self.state.get_encoder(self, i))
+            self.set_channel_mute(i, self.state.get_button(self, i))
         for i in range(8, 18):
-            self.set_channel_mute(i, self.state.get_button(i))
+            self.set_channel_mute(i, self.state.get_button(self, i))
 
     def set_channel_mute(self, channel, LED):
         "Send the mute value to the button"
@@ -226,20 +318,29 @@ class MidiController:
             self.set_button(channel, self.LED_BLINK)
 
     def set_ring(self, ring, value):
-        "Send the fader value to the encoder ring"
+        "Set the fader value of the encoder ring, sent on the next flush if it changed."
         "Turn on the appropriate LEDs on the encoder ring."
         # 0 = off, 1-11 = single, 17-27 = pan, 33-43 = fan, 49-54 = spread
         # normalize value (0.0 - 1.0) to 0 - 11 range
         # values below 0 mean disabled
+        if self.layer.meter_sources[ring] is not None and \
+                not self.touching(ring, self.loop.time()):
+            # the ring shows the meter
+            return
         if value >= 0.0:
-            self.outport.send(Message('control_change', channel=self.MC_CHANNEL,
-                                      control=self.MIDI_RING[ring],
-                                      value=self.map_lights(value)))
-#                                      value=33 + round(value * 11)))
+            lights = self.map_lights(value)
+#            lights = 33 + round(value * 11)
         else:
-            self.outport.send(Message('control_change', channel=self.MC_CHANNEL,
-                                      control=self.MIDI_RING[ring],
-                                      value=0))
+            lights = 0
+        self.set_lights(ring, lights)
+
+    def set_lights(self, ring, lights):
+        "Set the light pattern of the encoder ring, sent on the next flush if it changed."
+        if lights != self.lit_rings[ring]:
+            self.dirty_rings[ring] = lights
+            self.schedule_flush()
+        else:
+            self.dirty_rings.pop(ring, None)
 
     def map_lights(self, value):
         "map the (0:1) range of fader values to ring light patterns"
@@ -249,7 +350,75 @@ class MidiController:
             value = value + 22
         return value
 
+    def map_meter(self, level):
+        "map a meter level in dB to a fan of lights, off below the shown range"
+        if level <= -self._METER_RANGE:
+            return 0
+        return 33 + min(10, round((level + self._METER_RANGE) * 10 / self._METER_RANGE))
+
+    def touching(self, ring, now):
+        "Check if the encoder was turned or pressed within the hold time."
+        touched = self.touched[ring]
+        return touched is not None and now - touched < self._TOUCH_HOLD
+
+    def update_meters(self):
+        "Run the meter frames while the current layer shows meters."
+        if self.layer.meter_banks:
+            if self.meter_timer is None:
+                self.meter_timer = self.state.scheduler.every(1 / self._METER_FPS,
+                                                              self.meter_frame)
+        elif self.meter_timer is not None:
+            self.meter_timer.cancel()
+            self.meter_timer = None
+
+    def meter_frame(self):
+        """
+        Timer callback that shows the held meter peaks on the rings. The meters
+        arrive every 50ms per bank and mixer, drawing them at a fixed frame rate
+        sends at most one batch per frame, with only the rings that changed.
+        """
+        if self.state is None or self.state.quit_called:
+            return
+        now = self.loop.time()
+        mixers = self.state.mixers
+        for ring, source in enumerate(self.layer.meter_sources):
+            if source is None or self.touching(ring, now):
+                continue
+            mixer_name, bank, index = source
+            meter_bank = mixers[mixer_name].meters.banks.get(bank)
+            if meter_bank is None or index >= meter_bank.size:
+                lights = 0
+            else:
+                lights = self.map_meter(meter_bank.peak(index))
+            self.set_lights(ring, lights)
+
     def set_button(self, button, ch_on):
-        "Turn the button LED on or off"
-        self.outport.send(Message('note_on', channel=self.MC_CHANNEL,
-                                  note=self.MIDI_BUTTONS[button], velocity=ch_on))
+        "Turn the button LED on or off, sent on the next flush if it changed."
+        if ch_on != self.lit_buttons[button]:
+            self.dirty_buttons[button] = ch_on
+            self.schedule_flush()
+        else:
+            self.dirty_buttons.pop(button, None)
+
+    def schedule_flush(self):
+        "Flush all changes made in this event loop iteration as one batch."
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        "Send the LED values that differ from what is lit on the surface."
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.outport is None or self.outport.closed:
+            return
+        for ring, lights in self.dirty_rings.items():
+            self.outport.send(Message('control_change', channel=self.MC_CHANNEL,
+                                      control=self.MIDI_RING[ring], value=lights))
+            self.lit_rings[ring] = lights
+        for button, ch_on in self.dirty_buttons.items():
+            self.outport.send(Message('note_on', channel=self.MC_CHANNEL,
+                                      note=self.MIDI_BUTTONS[button], velocity=ch_on))
+            self.lit_buttons[button] = ch_on
+        self.dirty_rings.clear()
+        self.dirty_buttons.clear()
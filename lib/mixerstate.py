@@ -4,89 +4,40 @@
 # Additions Copyright (c) 2021 Ross Dickson
 # Some rights reserved. See LICENSE.
 
+import asyncio
 import time
-import subprocess
-import struct
 import json
-from collections import deque
-from lib.xair import XAirClient, find_mixer
-from lib.midicontroller import MidiController, TempoDetector
-
-class Channel:
+import os
+import pickle
+from lib.autogain import ClipProtection, parse_inputs
+from lib.commands import CommandRunner
+from lib.hotplug import SurfaceWatcher
+from lib.meters import Meters, meter_source
+from lib.metrics import Metrics, Profiler, add_signal
+from lib.scheduler import Scheduler
+from lib.snapshot import Snapshot, load_last_mixer, save_last_mixer
+from lib.state import BUSES, StateStore
+from lib.xair import XAirClient, XAirPool, find_mixers
+from lib.midicontroller import MidiController, TempoDetector, find_surfaces
+
+class OscRoute:
     """
-    Represents a single channel or bus
+    Target of an inbound OSC address: the mixer that sends it, the channel,
+    the kind of parameter, the bus or fx slot and the MixerState method that
+    handles it
     """
-    def __init__(self, addr):
-        # LR then 6 aux bus followed by the 4 effects
-        self.sends = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-        self.enables = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
-        self.osc_base_addr = addr
-
-    def get_m_addr(self, bus):
-        if bus == 0:
-            if self.osc_base_addr.startswith('/config'):
-                return(self.osc_base_addr)
-            else:
-                return(self.osc_base_addr + "/on")
-        else:
-            return(self.osc_base_addr + '/{:0>2d}/level'.format(bus))
+    __slots__ = ('mixer', 'channel', 'kind', 'bus', 'handler')
 
-    def get_l_addr(self, bus):
-        if bus == 0:
-            if self.osc_base_addr.startswith('/head'):
-                return(self.osc_base_addr + "/gain")
-            else:
-                return(self.osc_base_addr + "/fader")
-        else:
-            return(self.osc_base_addr + '/{:0>2d}/level'.format(bus))
-
-    def toggle_mute(self, bus):
-        """Toggle a mute on or off."""
-#        print("toggle mute of %s bus %s from %s" % (self.get_m_addr(bus), bus, self.enables[bus]))
-        if self.enables[bus] == 1:
-            self.enables[bus] = 0
-            param=0.0
-        else:
-            self.enables[bus] = 1
-            param=self.sends[bus]
-        if bus == 0:
-           return(self.get_m_addr(bus), self.enables[bus], self.enables[bus])
-        else:
-            return(self.get_m_addr(bus), param, self.enables[bus])
-
-    def set_mute(self, bus, value):
-        """Set the state of the channel mute."""
-        self.enables[bus] = value
-        return(self.get_m_addr(bus), self.enables[bus], self.enables[bus])
-
-    def get_mute(self, bus):
-        return(self.enables[bus])
-
-    def change_level(self, bus, delta):
-        """Change the level of a fader, mic pre, or bus send."""
-#        print("changing %s bus %s by %s" % (self.osc_base_addr, bus, delta))
-        if bus == "gain":
-            bus = 0
-        self.sends[bus] = min(max(0.0, self.sends[bus] + (delta / 200)), 1.0)
-        return(self.get_l_addr(bus), self.sends[bus], self.sends[bus])
-
-    def set_level(self, bus, value):
-        """Set the level of a fader, mic pre, or bus send."""
-        if bus == "gain":
-            bus = 0
-        self.sends[bus] = value
-        return(self.get_l_addr(bus),
-                    self.sends[bus], self.sends[bus])
-
-    def get_level(self, bus):
-        """Return the current level of a fader, mic pre, or bus send."""
-        if bus == "gain":
-            bus = 0
-        return(self.sends[bus])
+    def __init__(self, mixer, channel, kind, bus, handler):
+        self.mixer = mixer
+        self.channel = channel
+        self.kind = kind
+        self.bus = bus
+        self.handler = handler
 
 class SubProc:
     """
-    Manages a subprocess
+    An external command and the arguments it cycles through on each press
     """
     def __init__(self, call_type, proc_name, args) -> None:
         self.call_type = call_type
@@ -95,215 +46,352 @@ class SubProc:
         self.max = len(args)
         self.current = 0
 
-    def toggle(self):
-        if self.call_type == "subprocess":
-            try:
-                subprocess.call([self.proc_name, self.args[self.current]])
-            except OSError:
-                pass
-            self.current += (self.current + 1) % self.max
+    def next_argument(self):
+        "The argument for this press, the next press uses the following one."
+        argument = self.args[self.current]
+        self.current = (self.current + 1) % self.max
+        return argument
 
 # the config json file specifies a number of layers each idendified by a name
-# within the layer there are currently two sections: encoders and buttons
-# there are 8 encoders per section with three parts: channel, send/fader/gain, button
-
-# fader, channel, [button]
-# gain, channel
-# level, channel, bus, [button]
+# within the layer there are three sections: encoders, buttons and fader
+# there are 8 encoders per section with two parts: channel and press action
+#   none | reset, value | mute, channel, bus | subprocess, program, [arguments]
 # There are 18 buttons per section to types: lengths
 button_def = {'quit': 2, 'none': 2, 'layer': 4, 'clip': 2, 'mute': 2, 'tap': 2, "send": 2}
 button_types = set(button_def.keys())
+press_def = {'none': 1, 'reset': 2, 'mute': 3, 'subprocess': 3}
+
+# the config is compiled once into control records, events dispatch on these opcodes
+PRESS_NONE, PRESS_RESET, PRESS_MUTE, PRESS_SUBPROCESS = range(4)
+PRESS_OPS = {'none': PRESS_NONE, 'reset': PRESS_RESET, 'mute': PRESS_MUTE,
+             'subprocess': PRESS_SUBPROCESS}
+BUTTON_NONE, BUTTON_MUTE, BUTTON_LAYER, BUTTON_SEND, BUTTON_TAP, BUTTON_CLIP, BUTTON_QUIT = range(7)
+BUTTON_OPS = {'none': BUTTON_NONE, 'mute': BUTTON_MUTE, 'layer': BUTTON_LAYER,
+              'send': BUTTON_SEND, 'tap': BUTTON_TAP, 'clip': BUTTON_CLIP, 'quit': BUTTON_QUIT}
+FADER_NONE, FADER_QUIT, FADER_LEVEL = range(3)
+
+# bump when the compiled records change so stale config caches are rebuilt
+CONFIG_VERSION = 5
+# the highest pickle protocol every supported Python version can read
+_CACHE_PROTOCOL = 4
+
+class ConfigError(Exception):
+    "The config file can not be used"
+
+class EncoderControl:
+    """
+    An encoder: the channel it turns and the action when pressed, with the
+    reset value, mute target and bus already parsed
+    """
+    __slots__ = ('channel', 'press', 'value', 'target', 'bus', 'invert', 'proc')
+
+    def __init__(self, channel, press, value=0.0, target=None, bus=0, proc=None):
+        self.channel = channel
+        self.press = press
+        self.value = value
+        self.target = target
+        self.bus = bus
+        self.invert = target is not None and target.osc_base_addr.startswith('/config/mute')
+        self.proc = proc
+
+class ButtonControl:
+    """
+    A button: the opcode, the mute channel or target layer, the bus and the
+    LED state for buttons that do not follow the mixer
+    """
+    __slots__ = ('op', 'channel', 'target', 'bus', 'invert', 'led')
+
+    def __init__(self, op, channel=None, target=None, bus=0, led=None):
+        self.op = op
+        self.channel = channel
+        self.target = target
+        self.bus = bus
+        self.invert = channel is not None and channel.osc_base_addr.startswith('/config/mute')
+        self.led = led
+
+class FaderControl:
+    "The fader: quit, none or the channel and bus it sets"
+    __slots__ = ('op', 'channel', 'bus')
+
+    def __init__(self, op, channel=None, bus=0):
+        self.op = op
+        self.channel = channel
+        self.bus = bus
+
+def parse_number(kind, text, where, low=None, high=None):
+    "Parse a number from the config, checking it is in range."
+    try:
+        value = kind(text)
+    except (TypeError, ValueError):
+        raise ConfigError('%s has %r where a number is expected' % (where, text))
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise ConfigError('%s has %s outside %s to %s' % (where, value, low, high))
+    return value
+
+def parse_channel(text, where):
+    """
+    Split a channel reference into the mixer name and the OSC address, an
+    address without a 'mixer:' prefix is on the default mixer ''.
+    """
+    if not isinstance(text, str):
+        raise ConfigError('%s has %r where an OSC address is expected' % (where, text))
+    mixer, _, addr = text.rpartition(':')
+    if not addr.startswith('/') or '/' in mixer:
+        raise ConfigError('%s has %r where an OSC address is expected' % (where, text))
+    return mixer, addr
 
 class Layer:
     """
     Represents a logical layer as defined by the config file
     """
-    encoders = []
-    buttons = []
-    faders = []
-    channels = {}
-    proc_list = {}
-    active_bus = 0
-
-    def __init__(self, layer_name, config_layer, channels, layer_names, proc_list) -> None:
-        "Initialize a Layer"
-        # first check for gross configurations errors
-        number = len(config_layer.keys())
-        if number > 3:
-            print("Warning: expected exactly three types of controls %d found" % number)
-
-        # Process the encoders
-        self.encoders = config_layer["encoders"]
-        if len(self.encoders) != 8:
-            print("Layer %s does not contain 8 'encoder' definitions." % layer_name)
-        for encoder in self.encoders:
-            if len(encoder) != 2:
-                print("Error: Encoder %s of layer %s does not contain 2 elements, exiting." % \
-                    (encoder[0], layer_name))
-                exit()
-            if encoder[0] != "none" and encoder[0] not in channels.keys():
-                channels[encoder[0]] = Channel(encoder[0])
-            if encoder[1][0] == "mute" and encoder[1][1] not in channels.keys():
-                channels[encoder[1][1]] = Channel(encoder[1][1])
-            elif encoder[1][0] == "subprocess" and encoder[1][1] not in proc_list.keys():
-                proc_list[encoder[1][1]] = SubProc(encoder[1][0], encoder[1][1], encoder[1][2])
-
-        # Process the buttons
-        self.buttons = config_layer["buttons"]
-        if len(self.buttons) != 18:
-            print("Layer %s does not contain 18 'button' definitions." % layer_name)
-        for button in self.buttons:
-            if button[0] not in button_types:
-                print("Layer %s contains an unknown 'button' %s." % \
-                    (layer_name, button[0]))
-                exit()
-            if len(button) != button_def[button[0]]:
-                print("Error: Button %s of layer %s does not contain %d elements" % \
-                    (button[0], layer_name, button_def[button[0]]))
-            if button[0] == "layer" and button[1] not in layer_names:
-                print("Error: Layer %s has a change to undefined layer %s." % \
-                    (layer_name, button[1]))
-            if button[0] == "mute" and button[1] not in channels.keys():
-                channels[button[1]] = Channel(button[1])
-
-        # Process the fader
-        self.faders = config_layer["fader"]
-        if len(self.faders) != 1:
-            print("Layer %s does not contain 1 'fader' definitions." % layer_name)
-        for fader in self.faders:
-            if len(fader) != 2:
-                print("Error: Fader %s of layer %s does not contain 2 elements, exiting." % \
-                    (fader[0], layer_name))
-                exit()
-            if fader[0] != "none" and fader[0] != "quit" and fader[0] not in channels.keys():
-                channels[fader[0]] = Channel(fader[0])
-
-        self.channels = channels
+    def __init__(self, layer_name, config_layer, store, layer_names, proc_list) -> None:
+        "Compile and validate a layer, adding the channels it uses to the store"
+        self.name = layer_name
+        self.active_bus = 0
+        self.tap_button = -1
+        # channel -> list of (control type, index) that display it on the active bus
+        self.controls = {}
+        self.store = store
         self.proc_list = proc_list
+        if not isinstance(config_layer, dict):
+            raise ConfigError('Layer %s is not a dictionary' % layer_name)
+        for section, number in (('encoders', 8), ('buttons', 18), ('fader', 1)):
+            if not isinstance(config_layer.get(section), list) or \
+                    len(config_layer[section]) != number:
+                raise ConfigError("Layer %s does not contain %d '%s' definitions." %
+                                  (layer_name, number, section))
+        self.encoders = [self.compile_encoder(number, encoder)
+                         for number, encoder in enumerate(config_layer['encoders'])]
+        self.buttons = [self.compile_button(number, button, layer_names)
+                        for number, button in enumerate(config_layer['buttons'])]
+        self.fader = self.compile_fader(config_layer['fader'][0])
+        self.meters = config_layer.get('meters', False)
+        if not isinstance(self.meters, bool):
+            raise ConfigError("Layer %s 'meters' is not true or false" % layer_name)
+        # per encoder (mixer, bank, index) of the meter shown on its ring, or None
+        self.meter_sources = [None] * len(self.encoders)
+        if self.meters:
+            for number, encoder in enumerate(self.encoders):
+                if encoder.channel is not None:
+                    source = meter_source(encoder.channel.osc_base_addr)
+                    if source is not None:
+                        self.meter_sources[number] = (encoder.channel.mixer,) + source
+        self.meter_banks = {source[:2] for source in self.meter_sources if source is not None}
+
+    def channel(self, text, where):
+        "The Channel of a config reference, created on first use."
+        mixer, addr = parse_channel(text, where)
+        return self.store.channel(addr, mixer)
+
+    def compile_encoder(self, number, encoder):
+        where = 'Encoder %d of layer %s' % (number + 1, self.name)
+        if not isinstance(encoder, list) or len(encoder) != 2:
+            raise ConfigError('%s does not contain 2 elements' % where)
+        channel = None
+        if encoder[0] != 'none':
+            channel = self.channel(encoder[0], where)
+            self.add_control(channel, 'encoder', number)
+        press = encoder[1]
+        if not isinstance(press, list) or not press or not isinstance(press[0], str) or \
+                press[0] not in press_def:
+            raise ConfigError('%s has an unknown press action %r' % (where, press))
+        if len(press) != press_def[press[0]]:
+            raise ConfigError('%s press action %s does not contain %d elements' %
+                              (where, press[0], press_def[press[0]]))
+        op = PRESS_OPS[press[0]]
+        if op == PRESS_RESET:
+            if channel is None:
+                raise ConfigError('%s resets but has no channel' % where)
+            return EncoderControl(channel, op, value=parse_number(float, press[1], where, 0.0, 1.0))
+        if op == PRESS_MUTE:
+            target = self.channel(press[1], where)
+            return EncoderControl(channel, op, target=target,
+                                  bus=parse_number(int, press[2], where, 0, 10))
+        if op == PRESS_SUBPROCESS:
+            if not isinstance(press[1], str) or not isinstance(press[2], list) or not press[2] \
+                    or not all(isinstance(arg, str) for arg in press[2]):
+                raise ConfigError('%s needs a program and a list of arguments' % where)
+            if press[1] not in self.proc_list:
+                self.proc_list[press[1]] = SubProc(press[0], press[1], press[2])
+            return EncoderControl(channel, op, proc=self.proc_list[press[1]])
+        return EncoderControl(channel, op)
+
+    def compile_button(self, number, button, layer_names):
+        where = 'Button %d of layer %s' % (number + 1, self.name)
+        if not isinstance(button, list) or not button or button[0] not in button_types:
+            raise ConfigError('%s is unknown: %r' % (where, button))
+        if len(button) != button_def[button[0]]:
+            raise ConfigError('%s (%s) does not contain %d elements' %
+                              (where, button[0], button_def[button[0]]))
+        op = BUTTON_OPS[button[0]]
+        if op == BUTTON_MUTE:
+            channel = self.channel(button[1], where)
+            self.add_control(channel, 'button', number)
+            return ButtonControl(op, channel=channel)
+        if op == BUTTON_LAYER:
+            if button[1] not in layer_names:
+                raise ConfigError('%s changes to undefined layer %s' % (where, button[1]))
+            return ButtonControl(op, target=button[1],
+                                 bus=parse_number(int, button[2], where, 0, 10), led=button[3])
+        if op == BUTTON_SEND:
+            return ButtonControl(op, bus=parse_number(int, button[1], where, 0, 10))
+        if op == BUTTON_TAP and self.tap_button == -1:
+            self.tap_button = number
+        return ButtonControl(op, target=button[1], led=button[-1])
+
+    def compile_fader(self, fader):
+        where = 'Fader of layer %s' % self.name
+        if not isinstance(fader, list) or len(fader) != 2:
+            raise ConfigError('%s does not contain 2 elements' % where)
+        if fader[0] == 'quit':
+            return FaderControl(FADER_QUIT)
+        if fader[0] == 'none':
+            return FaderControl(FADER_NONE)
+        return FaderControl(FADER_LEVEL, self.channel(fader[0], where),
+                            parse_number(int, fader[1], where, 0, 10))
 
     def encoder_turn(self, number, value):
-        encoder = self.encoders[number]
-        if encoder[0] == "none":
+        channel = self.encoders[number].channel
+        if channel is None:
             return(None, None, 0.0)
-        return(self.channels[encoder[0]].change_level(self.active_bus, value))
+        return(channel.change_level(self.active_bus, value))
 
     def encoder_press(self, number):
         encoder = self.encoders[number]
-        if encoder[1][0] == "reset":
-            return(self.channels[encoder[0]].set_level(self.active_bus, float(encoder[1][1])))
-        elif encoder[1][0] == "mute":
-            (address, param, LED) = self.channels[encoder[1][1]].toggle_mute(int(encoder[1][2]))
-            return(address, param, self.channels[encoder[0]].get_level(self.active_bus))
-        elif encoder[1][0] == "subprocess":
-            self.proc_list[encoder[1][1]].toggle()
-            return(None, None, self.channels[encoder[0]].get_level(self.active_bus))
-        if encoder[0] == "none":
-            return(None, None, 0.0)
-        return(None, None, self.channels[encoder[0]].get_level(self.active_bus))
+        press = encoder.press
+        if press == PRESS_RESET:
+            return(encoder.channel.set_level(self.active_bus, encoder.value))
+        if press == PRESS_MUTE:
+            (address, param, LED) = encoder.target.toggle_mute(encoder.bus)
+            return(address, param, self.encoder_state(number))
+        return(None, None, self.encoder_state(number))
 
     def encoder_state(self, number):
-        encoder = self.encoders[number]
-        if encoder[0] == "none":
+        channel = self.encoders[number].channel
+        if channel is None:
             return 0.0
-        return(self.channels[encoder[0]].get_level(self.active_bus))
+        return(channel.get_level(self.active_bus))
 
     def toggle_button(self, number):
         button = self.buttons[number]
-        if button[0] == "mute":
-            return (self.channels[button[1]].toggle_mute(self.active_bus))
-        if button[0] == "layer":
-            max_bus = int(button[2])
-            return ("layer", button[1], max_bus if self.active_bus > max_bus else self.active_bus)
-        if button[0] == "send":
-            if self.active_bus == int(button[1]):
+        op = button.op
+        if op == BUTTON_MUTE:
+            return (button.channel.toggle_mute(self.active_bus))
+        if op == BUTTON_LAYER:
+            return ("layer", button.target,
+                    button.bus if self.active_bus > button.bus else self.active_bus)
+        if op == BUTTON_SEND:
+            if self.active_bus == button.bus:
                 self.active_bus = 0
                 return ("send", None, "Off")
             else:
-                self.active_bus = int(button[1])
+                self.active_bus = button.bus
                 return ("send", None, "On")
-        # return the relevant action for the non mixer based button
-        return (button[0], button[1], button[-1])
+        # the relevant action for the non mixer based button
+        return (None, button.target, button.led)
 
     def button_state(self, number):
         button = self.buttons[number]
-        if button[0] == "mute":
-            return(self.channels[button[1]].get_mute(self.active_bus))
-        elif button[0] == "send":
-            return("On" if self.active_bus == int(button[1]) else "Off")
+        if button.op == BUTTON_MUTE:
+            return(button.channel.get_mute(self.active_bus))
+        elif button.op == BUTTON_SEND:
+            return("On" if self.active_bus == button.bus else "Off")
         else:
-            return(button[-1])
+            return(button.led)
 
     def fader_move(self, value):
-        if self.faders[0][0] == "quit":
-            return("quit", "none", "none")
-        if self.faders[0][0] == "none":
-            return("none", "none", "none")
-        else:
-            return(self.channels[self.faders[0][0]].set_level(int(self.faders[0][1]), value))
-
-    def encoder_number(self, name):
-        number = 0
-        for encoder in self.encoders:
-            if name == encoder[0]:
-                return number
-            number += 1
-        return -1
-
-    def button_number(self, name):
-        number = 0
-        for button in self.buttons:
-            if len(button) > 1 and name == button[1]:
-                return number
-            number += 1
-        return -1
-
-class Meter:
+        fader = self.fader
+        if fader.op == FADER_LEVEL:
+            return(fader.channel.set_level(fader.bus, value))
+        return(None, None, None)
+
+    def add_control(self, channel, control, number):
+        "Record that a control shows a channel on the active bus."
+        self.controls.setdefault(channel, []).append((control, number))
+
+def compile_config(config_json):
+    """
+    Read and compile the layers of a config file, returns the layers, the
+    state store of the channels and the subprocesses they use.
+    """
+    try:
+        with open(config_json) as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError) as error:
+        raise ConfigError('Can not read %s: %s' % (config_json, error))
+    if not isinstance(config, dict) or not config:
+        raise ConfigError('%s does not define any layers' % config_json)
+    layers = {}
+    store = StateStore()
+    proc_list = {}
+    for layer_name, config_layer in config.items():
+        layers[layer_name] = Layer(layer_name, config_layer, store, config.keys(), proc_list)
+    return layers, store, proc_list
+
+def load_config(config_json, use_cache=False):
+    """
+    Compile a config file. With use_cache the compiled layers are pickled next
+    to the JSON and reused while the JSON is unchanged.
+    """
+    if not use_cache:
+        return compile_config(config_json)
+    cache_path = config_json + '.cache'
+    try:
+        stat = os.stat(config_json)
+        key = (CONFIG_VERSION, stat.st_mtime_ns, stat.st_size)
+    except OSError as error:
+        raise ConfigError('Can not read %s: %s' % (config_json, error))
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if cached[0] == key:
+            return cached[1]
+    except Exception:
+        # unpickling a truncated, corrupt or foreign cache can raise almost anything,
+        # it is rebuilt from the JSON
+        pass
+    compiled = compile_config(config_json)
+    try:
+        with open(cache_path + '.tmp', 'wb') as cache_file:
+            pickle.dump((key, compiled), cache_file, _CACHE_PROTOCOL)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as error:
+        print('Warning: Can not write config cache %s: %s' % (cache_path, error))
+    return compiled
+
+class Mixer:
     """
-    Calculates the .2 second running average of the value of a channel meter
+    One X-Air mixer: its connection, the routes of the addresses it sends us,
+    the configured channels on it and its effect slots, meters and snapshot
     """
-    values = 4
-    def __init__(self):
-        self.levels = deque(maxlen=self.values)
-        for _ in range(self.values):
-            self.levels.append(-102400)
-        self.mean = -102400 * self.values
-
-    def insert_level(self, value):
-        'push a vlue into the fixed FIFO and update the mean'
-        self.mean = self.mean - self.levels.popleft() + value
-        self.levels.append(value)
-        return self.mean
+    def __init__(self, name, address, channels):
+        self.name = name
+        self.address = address
+        self.channels = channels
+        self.client = None
+        self.routes = {}
+        self.fx_slots = [0, 0, 0, 0]
+        self.meters = Meters()
+        self.protection = None
+        self.snapshot = None
+        self.synced = False
+        self.sync_task = None
+
+    def label(self):
+        return self.name or 'mixer'
 
 class MixerState:
     """
     This stores the mixer state in the application. It also keeps
-    track of the current selected fader bank on the midi controller to
-    decide whether state changes from the X-Air device need to be
-    sent to the midi controller.
+    track of the current selected fader bank on every midi controller to
+    decide which of them state changes from the X-Air devices need to be
+    sent to.
     """
 
-    quit_called = False
-    layers = {}
-    channels = {}
-    proc_list = {}
-    current_layer = None
-
     # ID numbers for all available delay effects
     _DELAY_FX_IDS = [10, 11, 12, 21, 24, 25, 26]
-    
-    fx_slots = [0, 0, 0, 0]
-
-    lr = Channel('/lr/mix')
-
-    mpd_playing = True
-
-    midi_controller = None
-    xair_client = None
-    tempo_detector = None
-
-    meters = []
-    for i in range(16):
-        meters.append(Meter())
+    # seconds between saves of the snapshots of mixers whose state changed
+    _SNAPSHOT_INTERVAL = 30.0
 
     def __init__(self, args) -> None:
         # split the arguments out to useful values
@@ -313,98 +401,277 @@ class MixerState:
         self.clip = args.clip
         self.mac = False # args.mac
         self.levels = args.levels
+        self.coalesce = args.coalesce / 1000
+        self.metrics = Metrics(args.metrics, args.metrics_interval) if args.metrics else None
+        self.profiler = Profiler(args.profile) if args.profile else None
+        self.subscribed_meter_banks = [1, 2]
+        self.snapshot_dir = args.snapshot_dir
+        self.quit_called = False
+        self.quit_event = None
+        self.tempo_detector = None
+        self.pool = None
+        self.scheduler = None
+        self.watcher = None
+        self.midi_controllers = []
+        self.commands = CommandRunner()
 
         # initialize internal data structures
         config_json = "peterdikant.json"
         if args.config_file is not None:
             config_json = args.config_file[0]
-        with open(config_json) as config_file:
-            config = json.load(config_file)
-
-        layer_names = config.keys()
-
-        for layer_name in layer_names:
-            if self.current_layer == None:
-                self.current_layer = layer_name
-            self.layers[layer_name] = Layer(layer_name, config[layer_name],
-                                            self.channels, layer_names, self.proc_list)
+        try:
+            self.layers, self.store, self.proc_list = load_config(config_json, args.config_cache)
+        except ConfigError as error:
+            print('Error: %s, exiting.' % error)
+            exit()
+        self.channels = self.store.channels
+        # the layer each surface starts on, in port order
+        self.start_layers = args.layers or []
+        for layer_name in self.start_layers:
+            if layer_name not in self.layers:
+                print('Error: Unknown start layer %s, exiting.' % layer_name)
+                exit()
+        self.mixers = self.setup_mixers(args.mixers or [])
+        if self.clip or any(button.op == BUTTON_CLIP for layer in self.layers.values()
+                            for button in layer.buttons):
+            try:
+                inputs = parse_inputs(args.clip_inputs)
+            except ValueError as error:
+                print('Error: Clip inputs %s, exiting.' % error)
+                exit()
+            for mixer in self.mixers.values():
+                mixer.protection = self.setup_protection(mixer, inputs, args)
+        if self.metrics is not None:
+            # before the routes are compiled, so they call the timed handlers
+            self.metrics.instrument(self, 'received_level', 'received_mute',
+                                    'received_config_mute', 'received_fx_type',
+                                    'received_fx_param', 'received_meters',
+                                    'encoder_turn', 'button_press')
+            self.metrics.sources.append(lambda: [self.commands.health()])
+        for mixer in self.mixers.values():
+            mixer.routes = self.compile_routes(mixer)
+
+    def setup_mixers(self, definitions):
+        """
+        The mixers from the NAME=ADDRESS definitions and the default mixer, which
+        is used by channels without a mixer name and found on the network if
+        no address is given.
+        """
+        addresses = {}
+        for definition in definitions:
+            name, _, address = definition.partition('=')
+            if not name or not address or ':' in name or '/' in name:
+                print('Error: Mixer must be given as NAME=ADDRESS, not %s, exiting.' % definition)
+                exit()
+            addresses[name] = address
+        used = {channel.mixer for channel in self.channels.values()}
+        for name in sorted(used - set(addresses) - {''}):
+            print('Error: The config uses mixer %s which is not defined with --mixer, exiting.' %
+                  name)
+            exit()
+        names = list(addresses)
+        if '' in used or self.xair_address is not None or not names:
+            names.insert(0, '')
+            addresses[''] = self.xair_address
+        return {name: Mixer(name, addresses[name],
+                            [channel for channel in self.channels.values()
+                             if channel.mixer == name])
+                for name in names}
+
+    def setup_protection(self, mixer, inputs, args):
+        "Clip protection for the inputs of a mixer, their headamp gains are synced like the config."
+        channels = {}
+        for index in inputs:
+            channel = self.store.channel('/headamp/%02d' % (index + 1), mixer.name)
+            if channel not in mixer.channels:
+                mixer.channels.append(channel)
+            channels[index] = channel
+        return ClipProtection(self, mixer, channels, args.clip_threshold, args.clip_attack,
+                              args.clip_release, args.clip_step)
+
+    async def run(self):
+        "Run the remote on the event loop until quit is called."
+        self.quit_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self.scheduler = Scheduler(loop)
+        # a service manager stops the remote with SIGTERM, save the snapshots then too
+        add_signal(loop, 'SIGTERM', self.shutdown)
+        if self.metrics is not None:
+            self.metrics.start(self.scheduler)
+        if self.profiler is not None:
+            self.profiler.start(loop)
+        try:
+            if await self.initialize_state():
+                # now keep the /xremote and /meters subscriptions alive while running
+                for mixer in self.mixers.values():
+                    mixer.client.refresh_connection()
+                if self.snapshot_dir is not None:
+                    # the process may not see a clean exit, e.g. when the power is cut
+                    self.scheduler.every(self._SNAPSHOT_INTERVAL, self.save_snapshots)
+                await self.quit_event.wait()
+        finally:
+            self.shutdown()
 
-    def initialize_state(self):
+    async def initialize_state(self):
         self.quit_called = False
-        # determine the mixer address
-        if self.xair_address is None:
-            self.xair_address = find_mixer()
-            if self.xair_address is None:
+        # determine the address of the default mixer
+        default = self.mixers.get('')
+        discovered = default is not None and default.address is None
+        last_address = None
+        if discovered:
+            if self.snapshot_dir is not None:
+                last_address = load_last_mixer(self.snapshot_dir)
+            found = await asyncio.get_running_loop().run_in_executor(None, find_mixers,
+                                                                     last_address)
+            if found:
+                default.address = found[0][0]
+            else:
                 print('Error: Could not find any mixers in network.',
                       'Using default ip address.')
-                self.xair_address = "192.168.50.146"
+                default.address = "192.168.50.146"
 
         # setup other modules
-        self.midi_controller = MidiController(self)
-        if self.quit_called:
-            self.midi_controller = None
+        surfaces = find_surfaces()
+        if not surfaces:
+            print('X-Touch Mini not found. Make sure device is connected!')
             return False
-        self.xair_client = XAirClient(self.xair_address, self)
-        self.xair_client.validate_connection()
+        for number, (input_name, output_name) in enumerate(surfaces):
+            layer_name = self.start_layers[number] if number < len(self.start_layers) \
+                else next(iter(self.layers))
+            self.midi_controllers.append(MidiController(self, input_name, output_name, layer_name))
+            if self.quit_called:
+                return False
+        # all mixers share one socket
+        self.pool = XAirPool(self.metrics)
+        await self.pool.open()
+        for mixer in self.mixers.values():
+            mixer.client = XAirClient(mixer.address, self, mixer)
+            await mixer.client.connect(self.pool)
+            mixer.client.prepare_templates(mixer.channels)
+        await asyncio.gather(*(mixer.client.validate_connection()
+                               for mixer in self.mixers.values()))
         if self.quit_called:
-            self.midi_controller = None
-            self.xair_client = None
             return False
+        if discovered and self.snapshot_dir is not None and default.address != last_address:
+            save_last_mixer(self.snapshot_dir, default.address)
         self.tempo_detector = TempoDetector(self)
 
-        self.read_initial_state()
-        self.midi_controller.activate_bus()
-        self.tempo_detector.number = self.layers[self.current_layer].button_number("tap")
+        cold = []
+        for mixer in self.mixers.values():
+            if self.warm_start(mixer):
+                # paint the surfaces from the snapshot right away and let the sync
+                # correct whatever changed on the mixer while we were away
+                mixer.sync_task = asyncio.ensure_future(self.read_initial_state(mixer))
+            else:
+                cold.append(self.read_initial_state(mixer))
+        await asyncio.gather(*cold)
+        for controller in self.midi_controllers:
+            controller.activate_bus()
+            controller.start()
+        if self.monitor:
+            self.watcher = SurfaceWatcher(self)
+            self.watcher.start()
+        return True
+
+    def warm_start(self, mixer):
+        "Restore the state of a mixer from its snapshot, returns False if there is none."
+        if self.snapshot_dir is None or not mixer.client.info_response:
+            return False
+        mixer.snapshot = Snapshot(self.snapshot_dir, mixer.client.info_response)
+        if not mixer.snapshot.load():
+            return False
+        try:
+            restored = mixer.snapshot.apply(mixer.channels, self.store, mixer.fx_slots)
+        except (TypeError, ValueError, OverflowError) as error:
+            print('Warning: Can not restore the snapshot %s (%s), reading the mixer state.' %
+                  (mixer.snapshot.path, error))
+            return False
+        if self.debug:
+            print('Restored %d channels from %s' % (restored, mixer.snapshot.path))
         return True
 
     def shutdown(self):
+        "safely shutdown the mixer connections and the controllers"
         self.quit_called = True
-        "safely shutdown all threads"
-        if self.xair_client is not None:
-            self.xair_client.stop_server()
-            self.xair_client = None
-        if self.midi_controller is not None:
-            self.midi_controller.cleanup_controller()
-            self.midi_controller = None
+        if self.quit_event is not None:
+            self.quit_event.set()
+        for mixer in self.mixers.values():
+            if mixer.sync_task is not None:
+                mixer.sync_task.cancel()
+                mixer.sync_task = None
+            if mixer.snapshot is not None and mixer.synced:
+                mixer.snapshot.save(mixer.channels, self.store, mixer.fx_slots)
+                mixer.snapshot = None
+        if self.tempo_detector is not None:
+            self.tempo_detector.stop()
+            self.tempo_detector = None
+        for mixer in self.mixers.values():
+            if mixer.client is not None:
+                mixer.client.stop_server()
+                mixer.client = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        self.commands.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        for controller in self.midi_controllers:
+            controller.cleanup_controller()
+        self.midi_controllers = []
+        if self.metrics is not None:
+            self.metrics.stop()
+            self.metrics = None
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if self.scheduler is not None:
+            self.scheduler.stop()
 #        if self.screen_obj is not None:
 #            self.screen_obj.quit()
 
-    def button_press(self, number):
-        """Handle a button press."""
+    def button_press(self, surface, number):
+        """Handle a button press on a surface."""
         if self.debug:
             print('Button %d pressed' % number)
-        (address, param, LED) = self.layers[self.current_layer].toggle_button(number)
-        if address == 'layer':
-            self.current_layer = param
-            self.layers[self.current_layer].active_bus = LED
-            self.midi_controller.activate_bus()
-            self.tempo_detector.number = self.layers[self.current_layer].button_number("tap")
-            return self.get_button(number)
-        elif address == 'send':
-            self.midi_controller.activate_bus()
-            return LED
-        elif address == 'clip':
+        layer = surface.layer
+        button = layer.buttons[number]
+        op = button.op
+        (address, param, LED) = layer.toggle_button(number)
+        if op == BUTTON_MUTE:
+            if button.invert:
+                param = 1 if param == 0 else 0
+            self.client(button.channel).send(address=address, param=param)
+            # the mixer does not echo our own changes, show them on the other surfaces
+            self.show_mute(button.channel, layer.active_bus, LED)
+        elif op == BUTTON_LAYER:
+            surface.select_layer(param, LED)
+            surface.activate_bus()
+            if surface.layer.meter_banks:
+                self.show_meters(surface)
+            return self.get_button(surface, number)
+        elif op == BUTTON_SEND:
+            surface.activate_bus()
+        elif op == BUTTON_CLIP:
             self.clip = not self.clip
+            print('Clip protection %s' % ('on' if self.clip else 'off'))
+            if self.clip:
+                # start the meter subscription now rather than on the next renewal
+                for mixer in self.mixers.values():
+                    mixer.client.renew_now()
             return "On" if self.clip else "Off"
-        elif address == 'quit':
+        elif op == BUTTON_QUIT:
             self.shutdown()
-            exit()
-        elif address == 'record':
-            pass
-            return "Off"
-        elif address == 'tap':
+            return "none"
+        elif op == BUTTON_TAP:
             self.tempo_detector.tap()
             return "none"
-        if address != None:
-            if address.startswith('/config/mute'):
-                param = 1 if param == 0 else 0
-            self.xair_client.send(address=address, param=param)
         return LED
 
-    def get_button(self, number):
+    def get_button(self, surface, number):
         if self.debug:
             print('Getting state of button number %d' % number)
-        return(self.layers[self.current_layer].button_state(number))
+        return(surface.layer.button_state(number))
 
 #    def mac_button(self, button):
 #        "call a function for transport buttons on mac"
@@ -421,184 +688,273 @@ class MixerState:
 #        elif button == 14:
 #            os.system("""osascript -e 'tell application "music" to play'""")
 
-    def encoder_turn(self, number, delta):
+    def encoder_turn(self, surface, number, delta):
         """Change the level of an encoder."""
-        (address, param, LED) = self.layers[self.current_layer].encoder_turn(number, delta)
+        layer = surface.layer
+        (address, param, LED) = layer.encoder_turn(number, delta)
         if address != None:
-            self.xair_client.send(address=address, param=param)
+            channel = layer.encoders[number].channel
+            # the level is updated locally right away, only the send waits for the tick
+            self.client(channel).send_coalesced(address, param)
+            if len(self.midi_controllers) > 1:
+                self.show_level(channel, layer.active_bus, param)
         return LED
 
-    def encoder_press(self, number):
-        (address, param, LED) = self.layers[self.current_layer].encoder_press(number)
+    def encoder_press(self, surface, number):
+        layer = surface.layer
+        proc = layer.encoders[number].proc
+        if proc is not None:
+            # the command runs in the background, its rings are dark until it is done
+            if self.commands.submit(proc, proc.next_argument(), self.command_done):
+                self.show_command(proc, -1.0)
+                return -1.0
+        (address, param, LED) = layer.encoder_press(number)
         if address != None:
             print("sending %s %s" % (address, param))
-            if address.startswith('/config/mute'):
-                invert = 1 if param == 0 else 0
-                self.xair_client.send(address=address, param=invert)
-                number = self.layers[self.current_layer].button_number(address)
-                if number != -1:
-                    self.midi_controller.set_channel_mute(number, param)
+            encoder = layer.encoders[number]
+            client = self.client(encoder.channel if encoder.target is None else encoder.target)
+            if encoder.invert:
+                client.send(address=address, param=1 if param == 0 else 0)
             else:
-                self.xair_client.send(address=address, param=param)
+                client.send(address=address, param=param)
+            if encoder.target is not None:
+                self.show_mute(encoder.target, encoder.bus, encoder.target.get_mute(encoder.bus))
+            elif len(self.midi_controllers) > 1:
+                self.show_level(encoder.channel, layer.active_bus, param)
         return LED
 
-    def get_encoder(self, number):
+    def command_done(self, proc, success):
+        "Light the rings of a command again once it has finished."
+        if self.debug:
+            print('%s finished%s' % (proc.proc_name, '' if success else ' with an error'))
+        if proc not in self.commands.waiting:
+            self.show_command(proc, None)
+
+    def show_command(self, proc, value):
+        "Set the rings of the encoders running proc, None shows their level."
+        for controller in self.midi_controllers:
+            layer = controller.layer
+            for number, encoder in enumerate(layer.encoders):
+                if encoder.proc is proc:
+                    controller.set_ring(number, layer.encoder_state(number)
+                                        if value is None else value)
+
+    def get_encoder(self, surface, number):
         if self.debug:
             print('Getting state of encoder number %d' % number)
-        return(self.layers[self.current_layer].encoder_state(number))
+        return(surface.layer.encoder_state(number))
 
-    def fader_move(self, msg):
+    def fader_move(self, surface, msg):
         value = (msg.pitch + 8192) / 16384
         if self.debug:
             print('Wheel set to {}'.format(msg))
-        (address, param, LED) = self.layers[self.current_layer].fader_move(value)
-        if address == "quit":
+        layer = surface.layer
+        if layer.fader.op == FADER_QUIT:
             if value > .98:
                 self.shutdown()
-                exit()
-        elif address != 'none':
-            self.xair_client.send(address=address, param=param)
-
-    def received_osc(self, addr, value):
-        """Process an OSC input."""
-        prefix = None
-        three_element = '/'.join(addr.split('/',4)[:-1]) # first three parts of the OSC path
-        two_element = '/'.join(addr.split('/',3)[:-1]) # first two parts of the OSC path
-        if self.debug:
-            print('processing OSC message with %s and %s value.' % (addr, value))
-        if three_element in self.channels.keys():
-            prefix = three_element
-        elif two_element in self.channels.keys():
-            prefix = two_element
-        elif addr in self.channels.keys():
-            prefix = addr
-        if prefix is not None:
-            if addr.startswith('/config/mute'):
-                invert = 1 if value == 0 else 0
-                if self.debug:
-                    print ("  received mute channel %s" % prefix)
-                self.channels[prefix].set_mute(0, invert)
-                number = self.layers[self.current_layer].button_number(prefix)
-                if number != -1:
-                    self.midi_controller.set_channel_mute(number, invert)
-            elif addr.endswith('/fader'):     # chanel fader level
-                if self.debug:
-                    print('  Channel %s level %f' % (addr, value))
-                self.channels[prefix].set_level(0, value)
-                number = self.layers[self.current_layer].encoder_number(prefix)
-                if number != -1:
-                    self.midi_controller.set_ring(number, value)
-            elif addr.endswith('/on'):      # channel enable
-                if self.debug:
-                    print('  %s unMute %d' % (addr, value))
-                self.channels[prefix].set_mute(0, value)
-                number = self.layers[self.current_layer].button_number(prefix)
-                if number != -1:
-                    self.midi_controller.set_channel_mute(number, value)
-            elif addr.endswith('/level'):
-                if self.debug:
-                    print('  %s level %f' % (addr, value))
-                bus = int(addr[-8:-6])
-                self.channels[prefix].set_level(bus, value)
-                number = self.layers[self.current_layer].encoder_number(prefix)
-                if number != -1:
-                    self.midi_controller.set_ring(number, value)
-            elif addr.endswith('/gain'):
-                if self.debug:
-                    print('  %s Gain level %f' % (addr, value))
-                self.channels[prefix].set_level("gain", value)
-                number = self.layers[self.current_layer].encoder_number(prefix)
-                if number != -1:
-                    self.midi_controller.set_ring(number, value)
-            elif addr.startswith('/fx') and (addr.endswith('/par/01') or addr.endswith('/par/02')):
-                if self.fx_slots[int(addr[4:5]) - 1] in self._DELAY_FX_IDS:
-                    self.tempo_detector.current_tempo = value * 3
-            elif addr.startswith('/fx/') and addr.endswith('/type'):
-                self.fx_slots[int(addr[4:5]) - 1] = value
-                if value in self._DELAY_FX_IDS:
-                    # slot contains a delay, get current time value
-                    param_id = '01'
-                    if value == 10:
-                        param_id = '02'
-                    self.xair_client.send(address = '/fx/%s/par/%s' % (addr[4:5], param_id))
-            elif self.debug:
-                print('processing unknown OSC message with %s and %s value.' % (addr, value))
-
-    def read_initial_state(self):
-        """ Refresh state for all faders and mutes."""
-        for channel in self.channels.values():
+        elif layer.fader.op == FADER_LEVEL:
+            (address, param, LED) = layer.fader_move(value)
+            self.client(layer.fader.channel).send(address=address, param=param)
+            self.show_level(layer.fader.channel, layer.fader.bus, param)
+
+    def client(self, channel):
+        "The connection to the mixer of a channel."
+        return self.mixers[channel.mixer].client
+
+    def compile_routes(self, mixer):
+        """
+        Build the table of every OSC address a mixer can send us for the
+        configured channels, so an inbound message costs a single lookup.
+        """
+        routes = {}
+        for channel in mixer.channels:
             addr = channel.osc_base_addr
-            if addr.startswith('/head'):
-                self.xair_client.send(address=addr + '/gain')
-                time.sleep(self.xair_client._WAIT_TIME)
-            elif addr.startswith('/config'):
-                self.xair_client.send(address=addr)
-                time.sleep(self.xair_client._WAIT_TIME)
+            if addr.startswith('/config/mute'):
+                routes[addr] = OscRoute(mixer, channel, 'config_mute', 0, self.received_config_mute)
+            elif addr.startswith('/head'):
+                routes[channel.get_l_addr(0)] = OscRoute(mixer, channel, 'gain', 0, self.received_level)
             else:
-                self.xair_client.send(address=addr + '/fader')
-                time.sleep(self.xair_client._WAIT_TIME)
-                self.xair_client.send(address=addr + '/on')
-                time.sleep(self.xair_client._WAIT_TIME)
-                if channel.sends is not None:
-                    for k in range(len(channel.sends)):
-                        self.xair_client.send(address=addr + 
-                            '/{:0>2d}/level'.format(k + 1))
-                        time.sleep(self.xair_client._WAIT_TIME)
-        # get all fx types
-        for i in range(1, 5):
-            self.xair_client.send(address = '/fx/%d/type' % i)
-            time.sleep(self.xair_client._WAIT_TIME)
-    
+                routes[channel.get_l_addr(0)] = OscRoute(mixer, channel, 'fader', 0, self.received_level)
+                routes[channel.get_m_addr(0)] = OscRoute(mixer, channel, 'on', 0, self.received_mute)
+                if channel.has_sends():
+                    for bus in range(1, BUSES):
+                        routes[channel.get_l_addr(bus)] = OscRoute(mixer, channel, 'level', bus,
+                                                                   self.received_level)
+        for slot in range(4):
+            routes['/fx/%d/type' % (slot + 1)] = OscRoute(mixer, None, 'fx_type', slot,
+                                                          self.received_fx_type)
+            for param_id in ('01', '02'):
+                routes['/fx/%d/par/%s' % (slot + 1, param_id)] = OscRoute(
+                    mixer, None, 'fx_param', slot, self.received_fx_param)
+        for bank in range(17):
+            routes['/meters/%d' % bank] = OscRoute(mixer, None, 'meters', bank, self.received_meters)
+        return routes
+
+    def received_config_mute(self, route, value):
+        "A mute group, the mixer uses 1 for muted"
+        invert = 1 if value == 0 else 0
+        if self.debug:
+            print ("  received mute channel %s" % route.channel.osc_base_addr)
+        route.channel.set_mute(0, invert)
+        self.show_mute(route.channel, 0, invert)
+
+    def received_mute(self, route, value):
+        "Channel enable"
+        if self.debug:
+            print('  %s unMute %d' % (route.channel.osc_base_addr, value))
+        route.channel.set_mute(route.bus, value)
+        self.show_mute(route.channel, route.bus, value)
+
+    def received_level(self, route, value):
+        "Channel fader, bus send or headamp gain level"
+        if self.debug:
+            print('  %s %s %d level %f' % (route.channel.osc_base_addr, route.kind,
+                                           route.bus, value))
+        route.channel.set_level(route.bus, value)
+        self.show_level(route.channel, route.bus, value)
+
+    def show_level(self, channel, bus, value):
+        "Update the encoder rings that show the level of channel on bus on any surface."
+        for controller in self.midi_controllers:
+            layer = controller.layer
+            controls = layer.controls.get(channel)
+            if controls is None or layer.active_bus != bus:
+                continue
+            for control, number in controls:
+                if control == 'encoder':
+                    controller.set_ring(number, value)
+
+    def show_mute(self, channel, bus, value):
+        "Update the buttons that show the mute of channel on bus on any surface."
+        for controller in self.midi_controllers:
+            layer = controller.layer
+            controls = layer.controls.get(channel)
+            if controls is None or layer.active_bus != bus:
+                continue
+            for control, number in controls:
+                if control == 'button':
+                    controller.set_channel_mute(number, value)
+
+    def received_fx_param(self, route, value):
+        "Delay time of an effect slot"
+        if route.mixer.fx_slots[route.bus] in self._DELAY_FX_IDS:
+            self.tempo_detector.set_tempo(value * 3)
+
+    def received_fx_type(self, route, value):
+        "Effect type loaded in a slot"
+        route.mixer.fx_slots[route.bus] = value
+        if value in self._DELAY_FX_IDS:
+            # slot contains a delay, get current time value
+            param_id = '01'
+            if value == 10:
+                param_id = '02'
+            route.mixer.client.send(address = '/fx/%d/par/%s' % (route.bus + 1, param_id))
+
+    @staticmethod
+    def state_queries(channels, fx_types=True):
+        "The OSC addresses to read the state of channels and the fx types."
+        queries = []
+        for channel in channels:
+            queries.extend(channel.query_addresses())
+        if fx_types:
+            for i in range(1, 5):
+                queries.append('/fx/%d/type' % i)
+        return queries
+
+    async def read_initial_state(self, mixer):
+        """ Refresh state for all faders and mutes of a mixer."""
+        queries = self.state_queries(mixer.channels)
+        start = time.monotonic()
+        confirmed = await mixer.client.sync_state(queries)
+        mixer.synced = True
+        if mixer.snapshot is not None:
+            mixer.snapshot.save(mixer.channels, self.store, mixer.fx_slots)
+        if self.debug:
+            print('Initial state of %d parameters of %s read in %0.3fs%s' %
+                  (len(queries), mixer.label(), time.monotonic() - start,
+                   '' if confirmed else ' (incomplete)'))
+            if mixer.snapshot is not None and mixer.snapshot.channels:
+                print('%d channels changed since the snapshot' %
+                      mixer.snapshot.changed(mixer.channels, self.store))
+        return confirmed
+
+    def connection_lost(self, mixer):
+        "Called by the client when a mixer stopped answering."
+        if self.quit_called:
+            return
+        print('Warning: Lost connection to %s, reconnecting.' % mixer.label())
+        if mixer.sync_task is not None:
+            mixer.sync_task.cancel()
+        mixer.sync_task = asyncio.ensure_future(self.reconnect(mixer))
+
+    async def reconnect(self, mixer):
+        """
+        Wait for the mixer to answer again, then read back the channels shown on
+        the surfaces first and the rest of the state after them.
+        """
+        lost = time.monotonic()
+        while not self.quit_called:
+            if await mixer.client.validate_connection(required=False):
+                break
+        if self.quit_called:
+            return
+        mixer.client.resume()
+        shown = set()
+        for controller in self.midi_controllers:
+            shown.update(channel for channel in controller.layer.controls
+                         if channel.mixer == mixer.name)
+        await mixer.client.sync_state(self.state_queries(
+            [channel for channel in mixer.channels if channel in shown], fx_types=False))
+        print('Reconnected to %s after %0.1fs.' % (mixer.label(), time.monotonic() - lost))
+        await mixer.client.sync_state(self.state_queries(
+            [channel for channel in mixer.channels if channel not in shown]))
+        mixer.synced = True
+        mixer.sync_task = None
+
+    def save_snapshots(self):
+        "Timer callback that saves the snapshots of the synced mixers whose state changed."
+        for mixer in self.mixers.values():
+            if mixer.snapshot is not None and mixer.synced and \
+                    mixer.snapshot.modified(mixer.channels, self.store, mixer.fx_slots):
+                mixer.snapshot.save(mixer.channels, self.store, mixer.fx_slots)
+
     def update_tempo(self, tempo):
-        for i in range(0, 4):
-            if self.fx_slots[i] in self._DELAY_FX_IDS:
-                param_id = '01'
-                if self.fx_slots[i] == 10:
-                    # only delay where time is set as parameter 02
-                    param_id = '02'
-                self.xair_client.send(address = '/fx/%d/par/%s' % (i + 1, param_id), param = tempo / 3)
+        for mixer in self.mixers.values():
+            for i in range(0, 4):
+                if mixer.fx_slots[i] in self._DELAY_FX_IDS:
+                    param_id = '01'
+                    if mixer.fx_slots[i] == 10:
+                        # only delay where time is set as parameter 02
+                        param_id = '02'
+                    mixer.client.send(address = '/fx/%d/par/%s' % (i + 1, param_id),
+                                      param = tempo / 3)
 
 # the meter subscription is setup in the xair_client in the refresh method that runs every 5s
 # a subscription sends values every 50ms for 10s
 #
-# meters 1 provide data per channel and bus
+# meters 1 provide data per channel and bus, shown on the rings of meter layers
 # meters 2, input levels, as these will match the headamps even if mapped to other channels
-# layout below assumes meters 2
-
-    def received_meters(self, addr, data):
+# clip protection uses meters 2, see meter_source for the layout of both
+
+    def meters_wanted(self, mixer, bank):
+        "Check if the meter subscription of a bank on a mixer is needed."
+        if bank == 2 and (self.levels or self.clip):
+            return True
+        key = (mixer.name, bank)
+        return any(key in controller.layer.meter_banks for controller in self.midi_controllers)
+
+    def show_meters(self, surface):
+        "A surface switched to a meter layer, start the meter subscriptions it needs now."
+        for mixer_name in {mixer_name for mixer_name, bank in surface.layer.meter_banks}:
+            mixer = self.mixers.get(mixer_name)
+            if mixer is not None and mixer.client is not None:
+                mixer.client.renew_now()
+
+    def received_meters(self, route, blob):
         "receive an OSC Meters packet"
-        data_size = struct.unpack("<L", data[0][0:4])[0]
-        values = []
-        short = []
-        med = []
-        for i in range(data_size):
-            if i > 15:
-                break
-            # get the current meter as a 16bit signed int mapped to -128db to 128db
-            # 1/256 db resolution, aka .004 dB
-            # realistic values max at 0db
-            value = struct.unpack("<h", data[0][(4+(i*2)):4+((i+1)*2)])[0]
-            # push the value into the fixed length fifo and get the smoothed value
-            smooth = self.meters[i].insert_level(value)/1024
-            if self.debug:
-                values.append("%0.2f" % smooth)
-                short.append(value)
-                med.append(value/256)
-            if self.clip and smooth > -3 and (i < 8 or i > 11):
-                # if clip protection is enabled and not a drum and above -3 db
-                active_bank = self.active_bank
-                fader = i
-                if fader < 8:
-                    self.active_bank = 2
-                else:
-                    self.active_bank = 3
-                    fader = fader - 8
-                self.change_level(fader, -1) ## needs FIXME
-                if self.debug:
-                    print("Clipping Detected headamp changed to %s" %
-                          self.banks[self.active_bank][fader].fader)
-                self.active_bank = active_bank
-        if self.debug:
-            print('Meters %s ch 8 %s %s %s' % (addr, values[7], short[7], med[7]))
-#        if self.screen_obj is not None:
-#            self.screen_obj.screen_loop()
+        bank = route.mixer.meters.received(route.bus, blob)
+        if self.clip and route.bus == 2 and route.mixer.protection is not None:
+            route.mixer.protection.update(bank, time.monotonic())
+        if self.debug and bank.size > 7:
+            print('Meters %d ch 8 %0.2f %s %0.2f' % (route.bus, bank.level(7), bank.current[7],
+                                                    bank.current[7] / 256))
@@ -0,0 +1,114 @@
+"This module runs the timed and periodic work of the app from one event loop timer"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import heapq
+
+class Timer:
+    """
+    A callback due at an absolute loop time, repeated every `period` seconds
+    if a period is given. `last` is the deadline it last ran for.
+    """
+    __slots__ = ('deadline', 'period', 'callback', 'last', 'cancelled')
+
+    def __init__(self, deadline, period, callback):
+        self.deadline = deadline
+        self.period = period
+        self.callback = callback
+        self.last = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    """
+    Keeps all timers in one heap of absolute deadlines on the monotonic loop
+    clock, with a single loop timer for the earliest. A periodic timer is
+    rescheduled from its previous deadline, not from when it ran, so it does
+    not drift, and beats missed while the loop was busy are skipped.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.heap = []      # (deadline, sequence, timer)
+        self.sequence = 0
+        self.handle = None
+        self.handle_deadline = None
+        self.running = False
+
+    def time(self):
+        return self.loop.time()
+
+    def at(self, deadline, callback, period=None):
+        "Run callback at the loop time deadline, then every period seconds if given."
+        timer = Timer(deadline, period, callback)
+        self.push(timer)
+        return timer
+
+    def after(self, delay, callback):
+        "Run callback once, delay seconds from now."
+        return self.at(self.loop.time() + delay, callback)
+
+    def every(self, period, callback, start=None):
+        "Run callback every period seconds, first at start or one period from now."
+        if start is None:
+            start = self.loop.time() + period
+        return self.at(start, callback, period)
+
+    def push(self, timer):
+        self.sequence += 1
+        heapq.heappush(self.heap, (timer.deadline, self.sequence, timer))
+        if self.running:
+            # run sets the loop timer when it is done
+            return
+        if self.handle_deadline is None or timer.deadline < self.handle_deadline:
+            self.arm()
+
+    def arm(self):
+        "Set the loop timer to the earliest deadline."
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            self.handle_deadline = None
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if self.heap:
+            self.handle_deadline = self.heap[0][0]
+            self.handle = self.loop.call_at(self.handle_deadline, self.run)
+
+    def run(self):
+        "Loop timer callback that runs every timer that is due."
+        self.handle = None
+        self.handle_deadline = None
+        now = self.loop.time()
+        self.running = True
+        try:
+            while self.heap and self.heap[0][0] <= now:
+                _, _, timer = heapq.heappop(self.heap)
+                if timer.cancelled:
+                    continue
+                timer.last = timer.deadline
+                if timer.period:
+                    timer.deadline += timer.period
+                    if timer.deadline <= now:
+                        # skip the beats missed while the loop was busy
+                        missed = int((now - timer.deadline) / timer.period) + 1
+                        timer.deadline += missed * timer.period
+                    self.sequence += 1
+                    heapq.heappush(self.heap, (timer.deadline, self.sequence, timer))
+                timer.callback()
+        finally:
+            self.running = False
+            self.arm()
+
+    def stop(self):
+        "Cancel all timers."
+        for _, _, timer in self.heap:
+            timer.cancel()
+        self.heap = []
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            self.handle_deadline = None
@@ -0,0 +1,223 @@
+"This module simulates an X-Air mixer for offline testing and benchmarking"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import asyncio
+import math
+import random
+import socket
+import struct
+from pythonosc.osc_message import OscMessage, ParseError
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+# number of values in each /meters/N bank, banks not listed send 16 values
+METER_BANK_SIZES = {0: 8, 1: 40, 2: 36, 3: 56, 4: 100, 5: 44, 6: 60}
+
+def default_parameters():
+    "The parameters of an XR18 that the shipped configs use, with their power on values."
+    values = {}
+    def strip(base, fader=0.75, sends=0):
+        values[base + '/fader'] = fader
+        values[base + '/on'] = 1
+        for bus in range(1, sends + 1):
+            values[base + '/%02d/level' % bus] = 0.0
+    for channel in range(1, 17):
+        strip('/ch/%02d/mix' % channel, sends=10)
+        values['/headamp/%02d/gain' % channel] = 0.5
+    strip('/rtn/aux/mix', sends=10)
+    for number in range(1, 5):
+        strip('/rtn/%d/mix' % number, sends=10)
+        strip('/fxsend/%d/mix' % number)
+        values['/dca/%d/fader' % number] = 0.75
+        values['/dca/%d/on' % number] = 1
+        values['/config/mute/%d' % number] = 0
+        values['/fx/%d/type' % number] = 0
+        for param in range(1, 3):
+            values['/fx/%d/par/%02d' % (number, param)] = 0.5
+    for number in range(1, 7):
+        strip('/bus/%d/mix' % number, fader=0.375367)
+    strip('/lr/mix', fader=0.375367)
+    for number in range(17, 19):
+        values['/headamp/%02d/gain' % number] = 0.5
+    return values
+
+def encode(address, values):
+    "Encode an OSC message with a list of arguments."
+    builder = OscMessageBuilder(address=address)
+    for value in values:
+        builder.add_arg(value)
+    return builder.build().dgram
+
+class MixerSimulator(asyncio.DatagramProtocol):
+    """
+    Answers the OSC protocol of an X-Air mixer: /xinfo (also on broadcast),
+    queries and sets of the parameters, /xremote and /xremotenfb feedback and
+    /meters subscriptions. Latency and packet loss can be added to every
+    datagram sent or received.
+    """
+    _SUBSCRIPTION_LIFETIME = 10.0
+    _METER_INTERVAL = 0.05
+    SIGNALS = ['silence', 'sine', 'noise', 'clip']
+
+    def __init__(self, name='XR18-SIM', model='XR18', firmware='1.17', ip=None,
+                 latency=0.0, loss=0.0, signal='sine', seed=None, debug=False):
+        self.name = name
+        self.model = model
+        self.firmware = firmware
+        self.ip = ip
+        self.latency = latency
+        self.loss = loss
+        self.signal = signal
+        self.debug = debug
+        self.random = random.Random(seed)
+        self.values = default_parameters()
+        self.remote_clients = {}    # address -> (expiry, feedback to originator)
+        self.meter_clients = {}     # (address, bank) -> expiry
+        self.transport = None
+        self.loop = None
+        self.meter_timer = None
+        self.meter_ticks = 0
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.meter_timer = self.loop.call_later(self._METER_INTERVAL, self.send_meters)
+
+    def connection_lost(self, exc):
+        if self.meter_timer is not None:
+            self.meter_timer.cancel()
+            self.meter_timer = None
+
+    def lost(self):
+        "Decide if a datagram is lost on the simulated link."
+        if self.loss > 0 and self.random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    def sendto(self, dgram, addr):
+        "Send a datagram over the simulated link."
+        if self.transport is None or self.lost():
+            return
+        self.sent += 1
+        if self.latency > 0:
+            self.loop.call_later(self.latency, self.transport.sendto, dgram, addr)
+        else:
+            self.transport.sendto(dgram, addr)
+
+    def datagram_received(self, data, addr):
+        if self.lost():
+            return
+        self.received += 1
+        if self.latency > 0:
+            self.loop.call_later(self.latency, self.process, data, addr)
+        else:
+            self.process(data, addr)
+
+    def local_ip(self, addr):
+        "The address a client reaches this simulator on."
+        if self.ip is not None:
+            return self.ip
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect((addr[0], addr[1] or 1))
+            return probe.getsockname()[0]
+        except OSError:
+            return '127.0.0.1'
+        finally:
+            probe.close()
+
+    def process(self, data, addr):
+        "Handle one OSC message from a client."
+        try:
+            message = OscMessage(data)
+        except ParseError:
+            return
+        address = message.address
+        params = message.params
+        if self.debug:
+            print('%s:%d %s %s' % (addr[0], addr[1], address, params))
+        if address == '/xinfo':
+            self.sendto(encode('/xinfo', [self.local_ip(addr), self.name, self.model,
+                                          self.firmware]), addr)
+        elif address in ('/xremote', '/xremotenfb'):
+            self.remote_clients[addr] = (self.loop.time() + self._SUBSCRIPTION_LIFETIME,
+                                         address == '/xremote')
+        elif address == '/meters':
+            # requests for a bank that is not a number are ignored
+            if params and isinstance(params[0], str) and params[0].startswith('/meters/') \
+                    and params[0][8:].isdigit():
+                bank = int(params[0][8:])
+                self.meter_clients[(addr, bank)] = self.loop.time() + self._SUBSCRIPTION_LIFETIME
+        elif not params:
+            if address in self.values:
+                self.sendto(encode(address, [self.values[address]]), addr)
+        else:
+            self.set_value(address, params[0], addr)
+
+    def set_value(self, address, value, origin=None):
+        """
+        Store a parameter value and push it to the /xremote clients, call with no
+        origin to simulate a change made on the mixer itself.
+        """
+        self.values[address] = value
+        now = self.loop.time()
+        dgram = None
+        for client, (expiry, feedback) in list(self.remote_clients.items()):
+            if expiry < now:
+                del self.remote_clients[client]
+                continue
+            if client == origin and not feedback:
+                continue
+            if dgram is None:
+                dgram = encode(address, [value])
+            self.sendto(dgram, client)
+
+    def meter_value(self, bank, channel):
+        "The simulated meter level in 1/256 dB for the selected signal model."
+        if self.signal == 'silence':
+            level = -90.0
+        elif self.signal == 'noise':
+            level = self.random.uniform(-40.0, -10.0)
+        elif self.signal == 'clip':
+            level = -1.0 if channel % 4 == 0 else -30.0
+            if bank == 2:
+                # input levels follow the headamp gain, 72dB over the range
+                gain = self.values.get('/headamp/%02d/gain' % (channel + 1))
+                if gain is not None:
+                    level += (gain - 0.5) * 72
+        else:
+            phase = self.meter_ticks * self._METER_INTERVAL + channel * 0.7 + bank
+            level = -30.0 + 25.0 * math.sin(phase)
+        return int(level * 256)
+
+    def meter_blob(self, bank):
+        "Encode one /meters/N blob: a little endian count followed by int16 values."
+        size = METER_BANK_SIZES.get(bank, 16)
+        values = [self.meter_value(bank, channel) for channel in range(size)]
+        return struct.pack('<L%dh' % size, size, *values)
+
+    def send_meters(self):
+        "Timer callback that sends every active meter subscription every 50ms."
+        self.meter_ticks += 1
+        now = self.loop.time()
+        blobs = {}
+        for (client, bank), expiry in list(self.meter_clients.items()):
+            if expiry < now:
+                del self.meter_clients[(client, bank)]
+                continue
+            if bank not in blobs:
+                blobs[bank] = encode('/meters/%d' % bank, [self.meter_blob(bank)])
+            self.sendto(blobs[bank], client)
+        self.meter_timer = self.loop.call_later(self._METER_INTERVAL, self.send_meters)
+
+async def start_simulator(host='0.0.0.0', port=10024, **options):
+    "Start a simulator on the running loop, returns the transport and the simulator."
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(lambda: MixerSimulator(**options),
+                                               local_addr=(host, port), allow_broadcast=True)
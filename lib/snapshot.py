@@ -0,0 +1,138 @@
+"This module saves the last known mixer state for a warm start"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import json
+import os
+import re
+from array import array
+from lib.state import BUSES
+
+SNAPSHOT_VERSION = 1
+
+def default_directory():
+    "The per user cache directory for snapshots."
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'xair-remote')
+
+def mixer_identity(info):
+    "Key a snapshot by the model and name the mixer reports in /xinfo."
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', '%s-%s' % (info[2], info[1]))
+
+def valid_state(state):
+    "Check that a channel state from a snapshot holds BUSES levels in 0.0 - 1.0 and mutes."
+    if not isinstance(state, list) or len(state) != 2:
+        return False
+    levels, enables = state
+    return isinstance(levels, list) and len(levels) == BUSES and \
+        all(type(level) in (int, float) and 0.0 <= level <= 1.0 for level in levels) and \
+        isinstance(enables, list) and len(enables) == BUSES and \
+        all(type(enable) is int and enable in (0, 1) for enable in enables)
+
+def load_last_mixer(directory):
+    "The address of the mixer found last time, to probe it first."
+    try:
+        with open(os.path.join(directory, 'last-mixer')) as last_file:
+            return last_file.read().strip() or None
+    except OSError:
+        return None
+
+def save_last_mixer(directory, address):
+    "Remember the address of the mixer for the next discovery."
+    path = os.path.join(directory, 'last-mixer')
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as last_file:
+            last_file.write(address + '\n')
+        os.replace(path + '.tmp', path)
+    except OSError as error:
+        print('Warning: Can not save mixer address to %s: %s' % (path, error))
+
+class Snapshot:
+    """
+    The state of every channel and the fx slot types of one mixer, stored as
+    compact JSON in the cache directory
+    """
+    def __init__(self, directory, info):
+        self.path = os.path.join(directory, mixer_identity(info) + '.json')
+        self.channels = {}
+        self.fx_slots = None
+        self.restored = None    # copy of the state store right after apply
+        self.written = None     # copy of the state store and fx slots when last saved
+
+    def load(self):
+        "Read the snapshot, returns False if there is none or it is unusable."
+        try:
+            with open(self.path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(data, dict) or data.get('version') != SNAPSHOT_VERSION:
+            return False
+        channels = data.get('channels', {})
+        fx_slots = data.get('fx_slots')
+        if not isinstance(channels, dict) or \
+                not all(valid_state(state) for state in channels.values()):
+            return False
+        if fx_slots is not None and (not isinstance(fx_slots, list) or
+                                     not all(type(slot) is int for slot in fx_slots)):
+            return False
+        self.channels = channels
+        self.fx_slots = fx_slots
+        return True
+
+    def apply(self, channels, store, fx_slots):
+        """
+        Set the channels of the mixer known to the snapshot, returns the number
+        restored. The rows are filled in a copy of the store that is restored in
+        one step, so the store is unchanged if a state does not fit.
+        """
+        restored = 0
+        saved = store.copy()
+        levels, enables = saved
+        for channel in channels:
+            state = self.channels.get(channel.osc_base_addr)
+            if state is not None:
+                row = slice(channel.base, channel.base + BUSES)
+                levels[row] = array('d', state[0])
+                enables[row] = array('b', state[1])
+                restored += 1
+        store.restore(saved)
+        if self.fx_slots is not None and len(self.fx_slots) == len(fx_slots):
+            fx_slots[:] = self.fx_slots
+        self.restored = saved
+        return restored
+
+    def changed(self, channels, store):
+        "Count the channels of the mixer whose state differs from the snapshot."
+        if self.restored is None:
+            return len(channels)
+        changed = set(store.diff(self.restored))
+        return sum(1 for channel in channels if channel.index in changed)
+
+    def modified(self, channels, store, fx_slots):
+        "Check if the channels or fx slots of the mixer changed since the last save."
+        if self.written is None:
+            return True
+        saved, saved_fx_slots = self.written
+        if saved_fx_slots != list(fx_slots):
+            return True
+        changed = set(store.diff(saved))
+        return any(channel.index in changed for channel in channels)
+
+    def save(self, channels, store, fx_slots):
+        "Write the snapshot atomically, so a crash never leaves a partial file."
+        data = {'version': SNAPSHOT_VERSION,
+                'channels': {channel.osc_base_addr: channel.get_state() for channel in channels},
+                'fx_slots': list(fx_slots)}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as snapshot_file:
+                json.dump(data, snapshot_file, separators=(',', ':'))
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as error:
+            print('Warning: Can not save mixer snapshot to %s: %s' % (self.path, error))
+            return
+        self.written = (store.copy(), list(fx_slots))
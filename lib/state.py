@@ -0,0 +1,176 @@
+"This module stores the levels and mutes of every channel in flat arrays"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# LR then 6 aux bus followed by the 4 effects
+BUSES = 11
+
+class StateStore:
+    """
+    Levels and mutes of all channels in two contiguous arrays indexed by
+    channel id * BUSES + bus. Channel objects are views of one row, bulk
+    operations work on the whole arrays and are vectorized with NumPy when
+    it is available.
+    """
+    def __init__(self):
+        self.levels = array('d')
+        self.enables = array('b')
+        self.channels = {}      # channel reference -> Channel view
+        self.addresses = []     # channel id -> channel reference
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def add_row(self, reference):
+        "Add a row for a channel, returns its id."
+        self.levels.extend([0.0] * BUSES)
+        self.enables.extend([1] * BUSES)
+        self.addresses.append(reference)
+        return len(self.addresses) - 1
+
+    def channel(self, addr, mixer=''):
+        "The Channel view of an address on a mixer, its row is added on first use."
+        reference = mixer + ':' + addr if mixer else addr
+        channel = self.channels.get(reference)
+        if channel is None:
+            channel = self.channels[reference] = Channel(addr, self, mixer)
+        return channel
+
+    def copy(self):
+        "A copy of the whole state to diff or restore later."
+        return (self.levels[:], self.enables[:])
+
+    def restore(self, saved):
+        "Apply a saved state, like recalling a scene."
+        levels, enables = saved
+        self.levels[:len(levels)] = levels
+        self.enables[:len(enables)] = enables
+
+    def diff(self, saved):
+        "The ids of the channels whose state differs from a saved state."
+        levels, enables = saved
+        rows = len(levels) // BUSES
+        if rows == 0:
+            return []
+        if numpy is not None:
+            old_levels = numpy.frombuffer(levels, dtype=numpy.float64).reshape(rows, BUSES)
+            old_enables = numpy.frombuffer(enables, dtype=numpy.int8).reshape(rows, BUSES)
+            new_levels = numpy.frombuffer(self.levels, dtype=numpy.float64,
+                                          count=rows * BUSES).reshape(rows, BUSES)
+            new_enables = numpy.frombuffer(self.enables, dtype=numpy.int8,
+                                           count=rows * BUSES).reshape(rows, BUSES)
+            changed = (old_levels != new_levels).any(axis=1) | \
+                (old_enables != new_enables).any(axis=1)
+            return changed.nonzero()[0].tolist()
+        return [row for row in range(rows)
+                if levels[row * BUSES:(row + 1) * BUSES] !=
+                self.levels[row * BUSES:(row + 1) * BUSES] or
+                enables[row * BUSES:(row + 1) * BUSES] !=
+                self.enables[row * BUSES:(row + 1) * BUSES]]
+
+class Channel:
+    """
+    Represents a single channel or bus of a mixer, '' is the default mixer.
+    A view of its row in the state store
+    """
+    __slots__ = ('osc_base_addr', 'mixer', 'store', 'index', 'base')
+
+    def __init__(self, addr, store=None, mixer=''):
+        if store is None:
+            store = StateStore()
+        self.osc_base_addr = addr
+        self.mixer = mixer
+        self.store = store
+        self.index = store.add_row(mixer + ':' + addr if mixer else addr)
+        self.base = self.index * BUSES
+
+    def get_m_addr(self, bus):
+        if bus == 0:
+            if self.osc_base_addr.startswith('/config'):
+                return(self.osc_base_addr)
+            else:
+                return(self.osc_base_addr + "/on")
+        else:
+            return(self.osc_base_addr + '/{:0>2d}/level'.format(bus))
+
+    def get_l_addr(self, bus):
+        if bus == 0:
+            if self.osc_base_addr.startswith('/head'):
+                return(self.osc_base_addr + "/gain")
+            else:
+                return(self.osc_base_addr + "/fader")
+        else:
+            return(self.osc_base_addr + '/{:0>2d}/level'.format(bus))
+
+    def toggle_mute(self, bus):
+        """Toggle a mute on or off."""
+        enables = self.store.enables
+        slot = self.base + bus
+        if enables[slot] == 1:
+            enables[slot] = 0
+            param = 0.0
+        else:
+            enables[slot] = 1
+            param = self.store.levels[slot]
+        if bus == 0:
+            return(self.get_m_addr(bus), enables[slot], enables[slot])
+        else:
+            return(self.get_m_addr(bus), param, enables[slot])
+
+    def set_mute(self, bus, value):
+        """Set the state of the channel mute."""
+        self.store.enables[self.base + bus] = value
+        return(self.get_m_addr(bus), value, value)
+
+    def get_mute(self, bus):
+        return(self.store.enables[self.base + bus])
+
+    def has_sends(self):
+        "Only input channels and returns have per bus send levels."
+        return self.osc_base_addr.startswith('/ch/') or self.osc_base_addr.startswith('/rtn/')
+
+    def query_addresses(self):
+        "List the OSC addresses needed to read the state of this channel."
+        if self.osc_base_addr.startswith('/head'):
+            return [self.get_l_addr(0)]
+        if self.osc_base_addr.startswith('/config'):
+            return [self.osc_base_addr]
+        addresses = [self.get_l_addr(0), self.get_m_addr(0)]
+        if self.has_sends():
+            addresses.extend(self.get_l_addr(bus) for bus in range(1, BUSES))
+        return addresses
+
+    def change_level(self, bus, delta):
+        """Change the level of a fader, mic pre, or bus send."""
+        if bus == "gain":
+            bus = 0
+        levels = self.store.levels
+        slot = self.base + bus
+        levels[slot] = min(max(0.0, levels[slot] + (delta / 200)), 1.0)
+        return(self.get_l_addr(bus), levels[slot], levels[slot])
+
+    def set_level(self, bus, value):
+        """Set the level of a fader, mic pre, or bus send."""
+        if bus == "gain":
+            bus = 0
+        self.store.levels[self.base + bus] = value
+        return(self.get_l_addr(bus), value, value)
+
+    def get_level(self, bus):
+        """Return the current level of a fader, mic pre, or bus send."""
+        if bus == "gain":
+            bus = 0
+        return(self.store.levels[self.base + bus])
+
+    def get_state(self):
+        "The levels and mutes of the channel, as stored in a snapshot."
+        return [self.store.levels[self.base:self.base + BUSES].tolist(),
+                self.store.enables[self.base:self.base + BUSES].tolist()]
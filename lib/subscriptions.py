@@ -0,0 +1,85 @@
+"This module keeps the update subscriptions with the XAir mixer alive"
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import heapq
+import time
+
+class Subscription:
+    """
+    A mixer subscription that expires `lifetime` seconds after it was last
+    sent. It is renewed `margin` seconds before it expires.
+    """
+    def __init__(self, name, address, param=None, lifetime=10.0, margin=2.0, active=None):
+        self.name = name
+        self.address = address
+        self.param = param
+        self.lifetime = lifetime
+        self.margin = margin
+        self.active = active    # optional callable, the subscription is skipped while False
+        self.expires = None
+        # health counters
+        self.renewals = 0
+        self.missed = 0         # renewals sent after the subscription had already expired
+        self.received = 0       # packets received for this subscription
+
+    def renew(self, client, now):
+        "Send the subscription to the mixer, returns the time of the next renewal."
+        if self.active is not None and not self.active():
+            self.expires = None
+            return now + self.lifetime - self.margin
+        if self.expires is not None and now > self.expires:
+            self.missed += 1
+        client.send(address=self.address, param=self.param)
+        self.renewals += 1
+        self.expires = now + self.lifetime
+        return self.expires - self.margin
+
+    def health(self):
+        "One line summary of the health counters."
+        return '%s: %d renewals, %d missed, %d packets' % (self.name, self.renewals,
+                                                          self.missed, self.received)
+
+class SubscriptionManager:
+    """
+    Renews all subscriptions from one heap of deadlines
+    """
+    def __init__(self, client):
+        self.client = client
+        self.heap = []      # (deadline, sequence, subscription)
+        self.sequence = 0
+        self.by_name = {}
+
+    def add(self, subscription, deadline=None):
+        "Add a subscription, it is sent on the next run unless a deadline is given."
+        if deadline is None:
+            deadline = time.monotonic()
+        self.by_name[subscription.name] = subscription
+        self.sequence += 1
+        heapq.heappush(self.heap, (deadline, self.sequence, subscription))
+
+    def run(self, now):
+        "Renew all subscriptions that are due, returns the next deadline."
+        while self.heap and self.heap[0][0] <= now:
+            _, _, subscription = heapq.heappop(self.heap)
+            self.add(subscription, subscription.renew(self.client, now))
+        return self.heap[0][0] if self.heap else now + 1.0
+
+    def reset(self, now):
+        "Send every subscription on the next run, as after a restart of the mixer."
+        for subscription in self.by_name.values():
+            subscription.expires = None
+        self.heap = [(now, sequence, subscription) for _, sequence, subscription in self.heap]
+        heapq.heapify(self.heap)
+
+    def received(self, name):
+        "Count a packet received for a subscription."
+        subscription = self.by_name.get(name)
+        if subscription is not None:
+            subscription.received += 1
+
+    def health(self):
+        "Health counters of all subscriptions."
+        return [subscription.health() for subscription in self.by_name.values()]
@@ -4,23 +4,117 @@
 # Additions Copyright (c) 2021 Ross Dickson
 # Some rights reserved. See LICENSE.
 
-import time
-import threading
+import asyncio
 import socket
+import struct
+import time
+from collections import deque
 import netifaces
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import BlockingOSCUDPServer
-from pythonosc.osc_message import OscMessage
+from pythonosc.osc_message import OscMessage, ParseError as MessageParseError
+from pythonosc.osc_packet import OscPacket, ParseError
 from pythonosc.osc_message_builder import OscMessageBuilder
+from lib.subscriptions import Subscription, SubscriptionManager
+
+def osc_string(value):
+    "Encode a string as a null terminated OSC string padded to 4 bytes."
+    data = value.encode()
+    return data + b'\0' * (4 - len(data) % 4)
 
-class OSCClientServer(BlockingOSCUDPServer):
-    "The OSC communications agent"
-    def __init__(self, address, dispatcher):
-        super().__init__(('', 0), dispatcher)
+class OSCClientServer(asyncio.DatagramProtocol):
+    "The OSC communications agent, a datagram protocol on the event loop"
+    # single argument types that are sent from a pre-encoded template
+    _ARG_TYPES = {float: ('f', struct.Struct('>f')), int: ('i', struct.Struct('>i'))}
+
+    def __init__(self, address, handler, error_handler=None):
         self.xr_address = address
+        self.handler = handler
+        self.error_handler = error_handler
+        self.transport = None
+        self.pool = None
+        self.dropped = 0
+        self.send_errors = 0
+        self.queries = {}
+        self.templates = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        "Parse a datagram and pass each message to the handler."
+        try:
+            if OscMessage.dgram_is_message(data):
+                message = OscMessage(data)
+                self.handler(message.address, *message.params)
+            else:
+                for timed_message in OscPacket(data).messages:
+                    self.handler(timed_message.message.address, *timed_message.message.params)
+        except (ParseError, MessageParseError):
+            self.dropped += 1
+
+    def error_received(self, exc):
+        "A send to the mixer failed, e.g. because the network is down."
+        self.send_errors += 1
+        if self.error_handler is not None:
+            self.error_handler(exc)
+
+    def close(self):
+        if self.pool is not None:
+            # the socket is shared with the other mixers, only stop receiving
+            self.pool.detach(self)
+        elif self.transport is not None:
+            self.transport.close()
+        self.transport = None
+
+    def prepare(self, address, arg_type=None):
+        """
+        Pre-encode the address and type tags of a message. Returns the datagram
+        for a query (arg_type None) or the template (buffer, offset, packer).
+        """
+        if arg_type is None:
+            dgram = self.queries.get(address)
+            if dgram is None:
+                dgram = self.queries[address] = osc_string(address) + osc_string(',')
+            return dgram
+        template = self.templates.get((address, arg_type))
+        if template is None:
+            tag, packer = self._ARG_TYPES[arg_type]
+            head = osc_string(address) + osc_string(',' + tag)
+            template = (bytearray(head) + bytearray(packer.size), len(head), packer)
+            self.templates[(address, arg_type)] = template
+        return template
+
+    def encode_message(self, address, value):
+        """
+        Return the datagram for a message. Queries and single float or int values
+        only pack the payload into the cached template buffer, which is reused by
+        the next send to the same address.
+        """
+        if value is None:
+            return self.prepare(address)
+        if isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        if type(value) in self._ARG_TYPES:
+            buffer, offset, packer = self.prepare(address, type(value))
+            packer.pack_into(buffer, offset, value)
+            return buffer
+        return self.build_message(address, value)
 
     def send_message(self, address, value):
         "Packs a message for sending via OSC over UDB."
+        pool = self.pool
+        if pool is None:
+            self.transport.sendto(self.encode_message(address, value), self.xr_address)
+            return
+        # the transport reports a failed send to the pool while sendto runs
+        pool.sending = self
+        try:
+            self.transport.sendto(self.encode_message(address, value), self.xr_address)
+        finally:
+            pool.sending = None
+
+    @staticmethod
+    def build_message(address, value):
+        "Encode a message of any argument types with the python-osc builder."
         builder = OscMessageBuilder(address=address)
         if value is None:
             values = []
@@ -30,56 +124,261 @@ class OSCClientServer(BlockingOSCUDPServer):
             values = [value]
         for val in values:
             builder.add_arg(val)
-        msg = builder.build()
-        self.socket.sendto(msg.dgram, self.xr_address)
+        return builder.build().dgram
+
+class XAirPool(asyncio.DatagramProtocol):
+    """
+    One UDP socket shared by the connections to every mixer, received
+    datagrams are passed to the connection of the mixer that sent them
+    """
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.transport = None
+        self.servers = {}   # (ip, port) -> OSCClientServer
+        self.sending = None # the server whose datagram is being sent
+        self.unknown = 0
+
+    async def open(self):
+        "Open the socket on the event loop."
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', 0))
+        if self.metrics is not None:
+            self.transport.sendto = self.metrics.timed(
+                'osc_out', self.transport.sendto, size=lambda data, addr=None: len(data))
+            self.metrics.sources.append(self.health)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def attach(self, server):
+        "Start sending and receiving for the mixer at the server's address."
+        server.pool = self
+        server.transport = self.transport
+        self.servers[server.xr_address] = server
+
+    def detach(self, server):
+        if self.servers.get(server.xr_address) is server:
+            del self.servers[server.xr_address]
+        server.pool = None
+
+    def datagram_received(self, data, addr):
+        server = self.servers.get(addr)
+        if server is None:
+            self.unknown += 1
+            return
+        server.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        "Pass a failed send to the connection of the mixer it was sent to."
+        if self.sending is not None:
+            self.sending.error_received(exc)
+
+    def health(self):
+        "Report lines on the datagrams from addresses that are not a configured mixer."
+        return ['counter osc_in.unknown_sender %d' % self.unknown]
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+class StateSync:
+    """
+    Reads a set of parameters from the mixer with a bounded window of
+    outstanding queries. Replies are matched to queries by OSC address, a
+    query that is not answered within the timeout is sent again and given
+    up on after the retry limit.
+    """
+    def __init__(self, client, addresses, window, timeout, retries):
+        self.client = client
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.queue = deque(dict.fromkeys(addresses))
+        self.pending = {}   # address -> [deadline, attempts]
+        self.failed = []
+        self.loop = asyncio.get_running_loop()
+        self.timer = None
+        self.done = asyncio.Event()
+
+    def confirm(self, addr):
+        "Mark a query as answered and refill the window."
+        if self.pending.pop(addr, None) is not None:
+            self.fill(self.loop.time())
+
+    def fill(self, now):
+        "Send queued queries until the window is full."
+        while self.queue and len(self.pending) < self.window:
+            addr = self.queue.popleft()
+            self.pending[addr] = [now + self.timeout, 1]
+            self.client.send(addr)
+        if not self.pending:
+            self.finish()
+        elif self.timer is None:
+            self.timer = self.loop.call_at(now + self.timeout, self.expire)
+
+    def expire(self):
+        "Resend or give up on the queries that timed out."
+        self.timer = None
+        if self.client.state.quit_called or self.client.server is None:
+            self.finish()
+            return
+        now = self.loop.time()
+        for addr, entry in list(self.pending.items()):
+            if entry[0] > now:
+                continue
+            if entry[1] >= self.retries:
+                del self.pending[addr]
+                self.failed.append(addr)
+            else:
+                entry[0] = now + self.timeout
+                entry[1] += 1
+                self.client.send(addr)
+        self.fill(now)
+        if self.pending and self.timer is None:
+            self.timer = self.loop.call_at(min(entry[0] for entry in self.pending.values()),
+                                           self.expire)
+
+    def finish(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.done.set()
+
+    async def run(self):
+        "Send all queries and wait until each is answered or has failed."
+        self.fill(self.loop.time())
+        await self.done.wait()
+        return len(self.failed) == 0 and not self.queue and not self.pending
 
 class XAirClient:
     """
     Handles the communication with the X-Air mixer via the OSC protocol
     """
-    _CONNECT_TIMEOUT = 0.5
-    _WAIT_TIME = 0.002
-    _REFRESH_TIMEOUT = 5
+    _CONNECT_TIMEOUT = 3.0
+    _CONNECT_RETRY = 0.1
+    _SUBSCRIPTION_LIFETIME = 10.0
+    _SUBSCRIPTION_MARGIN = 2.0
+    _HEARTBEAT_INTERVAL = 1.0
+    _LIVENESS_TIMEOUT = 3.0
+    _SYNC_WINDOW = 16
+    _SYNC_TIMEOUT = 0.25
+    _SYNC_MIN_TIMEOUT = 0.05
+    _SYNC_RETRIES = 4      # attempts per query, the first send included
 
     XAIR_PORT = 10024
 
-    info_response = []
-
-    def __init__(self, address, state):
+    def __init__(self, address, state, mixer):
         self.state = state
-        dispatcher = Dispatcher()
-        dispatcher.set_default_handler(self.msg_handler)
-        self.server = OSCClientServer((address, self.XAIR_PORT), dispatcher)
-        worker = threading.Thread(target=self.run_server)
-        worker.daemon = True
-        worker.start()
-
-    def validate_connection(self):
-        "Confirm that the connection to the XAir is live, otherwise initiaties shutdown."
-        self.send('/xinfo')
-        time.sleep(self._CONNECT_TIMEOUT)
+        self.mixer = mixer
+        self.info_response = []
+        self.info_received = None
+        self.rtt = None
+        self.sync = None
+        self.routes = mixer.routes
+        self.subscriptions = SubscriptionManager(self)
+        self.renewal = None
+        self.last_received = time.monotonic()
+        self.alive = False
+        # address -> [param, time first queued] of sets waiting for the coalesce tick
+        self.coalesced = {}
+        self.coalesce_handle = None
+        self.coalesce_queued = 0
+        self.coalesce_sent = 0
+        self.coalesce_latency = 0.0
+        self.coalesce_max_latency = 0.0
+        # the address may carry a port, e.g. to reach a simulator
+        host, _, port = address.partition(':')
+        handler = self.msg_handler
+        metrics = state.metrics
+        if metrics is not None:
+            handler = metrics.timed('msg_handler', metrics.classified(self.routes, handler))
+        self.server = OSCClientServer((host, int(port) if port else self.XAIR_PORT), handler,
+                                      self.send_failed)
+        if metrics is not None:
+            self.server.datagram_received = metrics.timed(
+                'osc_in', self.server.datagram_received, size=lambda data, addr: len(data))
+            metrics.sources.append(self.health)
+
+    async def connect(self, pool):
+        "Resolve the mixer address and send and receive on the shared socket of the pool."
+        host, port = self.server.xr_address
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            # replies are matched to the mixer by the address they come from
+            self.server.xr_address = infos[0][4]
+        except socket.gaierror as error:
+            print('Error: Can not resolve mixer address %s: %s' % (host, error))
+        pool.attach(self.server)
+
+    async def validate_connection(self, required=True):
+        """
+        Confirm that the connection to the XAir is live, otherwise initiaties shutdown
+        if the connection is required. /xinfo is sent again with doubling waits
+        until the reply arrives or the connect timeout has passed, the round trip
+        time of the reply is kept. Returns True if the mixer answered.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._CONNECT_TIMEOUT
+        wait = self._CONNECT_RETRY
+        self.info_response = []
+        self.info_received = asyncio.Event()
+        try:
+            while not self.info_received.is_set() and self.server is not None:
+                sent = loop.time()
+                self.send('/xinfo')
+                try:
+                    await asyncio.wait_for(self.info_received.wait(),
+                                           min(wait, max(deadline - sent, 0)))
+                    # a late reply to an earlier try makes this an underestimate
+                    self.rtt = loop.time() - sent
+                except asyncio.TimeoutError:
+                    if loop.time() >= deadline:
+                        break
+                    wait *= 2
+        finally:
+            self.info_received = None
         if len(self.info_response) > 0:
             print('Successfully connected to %s with firmware %s at %s.' % (self.info_response[2],
                     self.info_response[3], self.info_response[0]))
-        else:
+            if self.state.debug:
+                print('Round trip time to %s %0.1fms' % (self.mixer.label(), self.rtt * 1000))
+            self.alive = True
+            return True
+        if required:
             print('Error: Failed to setup OSC connection to mixer.',
                   'Please check for correct ip address.')
             self.state.quit_called = True
-            if self.server is not None:
-                self.server.shutdown()
-                self.server = None
+            self.stop_server()
+        return False
 
-    def run_server(self):
-        "Start the OSC communications agent in a seperate thread."
-        try:
-            self.server.serve_forever()
-        except KeyboardInterrupt:
-            self.quit()
+    def health(self):
+        "Report lines on the connection health, labelled with the mixer name if it has one."
+        label = self.mixer.name + ' ' if self.mixer.name else ''
+        lines = ['counter %sosc_in.dropped %d' % (label, self.server.dropped if self.server else 0),
+                 'counter %sosc_out.errors %d' % (label,
+                                                  self.server.send_errors if self.server else 0)]
+        if self.rtt is not None:
+            lines.append('%srtt %0.2fms' % (label, self.rtt * 1000))
+        lines.extend('subscription ' + label + line for line in self.subscriptions.health())
+        lines.append(label + self.coalesce_stats())
+        return lines
 
     def stop_server(self):
+        if self.renewal is not None:
+            self.renewal.cancel()
+            self.renewal = None
+        if self.coalesce_handle is not None:
+            self.coalesce_handle.cancel()
+            self.flush_coalesced()
         if self.server is not None:
-            self.server.shutdown()
+            self.server.close()
             self.server = None
+            if self.state.debug:
+                for line in self.subscriptions.health():
+                    print(line)
+                print(self.coalesce_stats())
 
     def quit(self):
         if self.state is not None:
@@ -93,75 +392,251 @@ class XAirClient:
             self.stop_server()
             return
         #print 'OSCReceived("%s", %s, %s)' % (addr, tags, data)
-        if addr.endswith('/fader') or addr.endswith('/on') or addr.endswith('/level') or \
-                addr.startswith('/config/mute') or addr.endswith('/gain') or addr.startswith('/fx/'):
-            self.state.received_osc(addr, data[0])
+        self.last_received = time.monotonic()
+        route = self.routes.get(addr)
+        if route is not None and not data:
+            # a query echo or a reply without a value carries no state
+            self.server.dropped += 1
+            return
+        sync = self.sync
+        if sync is not None:
+            sync.confirm(addr)
+        if route is not None:
+            route.handler(route, data[0])
+            if route.kind == 'meters':
+                self.subscriptions.received(addr)
         elif addr == '/xinfo':
             self.info_response = data[:]
-        elif addr.startswith('/meters'):
-            self.state.received_meters(addr, data)
+            if self.info_received is not None:
+                self.info_received.set()
+            self.subscriptions.received('heartbeat')
         elif addr.startswith('/-'):
             pass
-        else:         #if self.state.debug and addr.start:
+        elif self.state.debug:
             print('OSCReceived("%s", %s)' % (addr, data))
 
-    def refresh_connection(self): # the main loop
+    def refresh_connection(self):
         """
         Tells mixer to send changes in state that have not been received from this OSC Client
           /xremote        - all parameter changes are broadcast to all active clients (Max 4)
           /xremotefnb     - No Feed Back. Parameter changes are only sent to the active clients
                                                                 which didn't initiate the change
+        Both /xremotenfb and /meters subscriptions expire after 10s and are renewed
+        with a safety margin by the subscription manager on an event loop timer.
+        A /xinfo heartbeat makes sure the mixer answers at least once a second,
+        if nothing is received for a few seconds the connection is lost.
         """
         if self.state.debug:
             print("Refresh Connection %s" % self.state.levels)
+        self.subscriptions.add(Subscription('/xremotenfb', '/xremotenfb',
+                                            lifetime=self._SUBSCRIPTION_LIFETIME,
+                                            margin=self._SUBSCRIPTION_MARGIN))
+        # bank 2 has the input levels, as these match the headamps when channels are
+        # remapped, bank 1 the channel levels for the meter layers
+        for bank in self.state.subscribed_meter_banks:
+            self.subscriptions.add(Subscription('/meters/%d' % bank, '/meters', ['/meters/%d' % bank],
+                                                lifetime=self._SUBSCRIPTION_LIFETIME,
+                                                margin=self._SUBSCRIPTION_MARGIN,
+                                                active=lambda bank=bank:
+                                                self.state.meters_wanted(self.mixer, bank)))
+        self.subscriptions.add(Subscription('heartbeat', '/xinfo',
+                                            lifetime=self._LIVENESS_TIMEOUT,
+                                            margin=self._LIVENESS_TIMEOUT - self._HEARTBEAT_INTERVAL))
+        self.last_received = time.monotonic()
+        self.renew_subscriptions()
+
+    def resume(self):
+        "Subscribe again after the mixer is back, it forgot all subscriptions if it restarted."
+        self.last_received = time.monotonic()
+        self.alive = True
+        self.renew_now()
+
+    def renew_now(self):
+        "Send all subscriptions right away, e.g. when a meter subscription became active."
+        if not self.alive:
+            return
+        if self.renewal is not None:
+            self.renewal.cancel()
+        self.subscriptions.reset(time.monotonic())
+        self.renew_subscriptions()
+
+    def send_failed(self, error):
+        "A send to the mixer failed, reconnect unless that is already going on."
+        if self.state.debug:
+            print('Send to %s failed: %s' % (self.mixer.label(), error))
+        if self.alive:
+            self.connection_lost()
+
+    def connection_lost(self):
+        "Stop renewing and let the state reconnect."
+        self.alive = False
+        if self.renewal is not None:
+            self.renewal.cancel()
+            self.renewal = None
+        self.state.connection_lost(self.mixer)
+
+    def renew_subscriptions(self):
+        "Timer callback that renews the due subscriptions and schedules the next renewal."
+        self.renewal = None
+        if self.state.quit_called or self.server is None:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if time.monotonic() - self.last_received > self._LIVENESS_TIMEOUT:
+            self.connection_lost()
+            return
+        deadline = self.subscriptions.run(now)
+        if not self.alive:
+            # a renewal could not be sent
+            return
+        self.renewal = self.state.scheduler.at(deadline, self.renew_subscriptions)
+
+    def prepare_templates(self, channels):
+        "Pre-encode the set and query messages for the channel addresses from the config."
+        for channel in channels:
+            for address in channel.query_addresses():
+                self.server.prepare(address)
+                if address.endswith('/on') or address.startswith('/config'):
+                    self.server.prepare(address, int)
+                else:
+                    self.server.prepare(address, float)
+
+    def sync_timeout(self):
+        """
+        How long to wait for the reply to a query before it is sent again, a few
+        round trips so a lost packet on a fast network costs little.
+        """
+        if self.rtt is None:
+            return self._SYNC_TIMEOUT
+        return max(self._SYNC_MIN_TIMEOUT, 4 * self.rtt)
+
+    async def sync_state(self, addresses):
+        """
+        Query every address in the list and wait until all have been answered
+        or retried out. Returns True if every parameter was confirmed.
+        """
+        self.sync = StateSync(self, addresses, self._SYNC_WINDOW,
+                              self.sync_timeout(), self._SYNC_RETRIES)
         try:
-            while not self.state.quit_called and self.server is not None:
-                self.server.send_message("/xremotenfb", None)
-                if self.state.levels or self.state.clip:
-                    # using input levels, as these match the headamps when channels are remapped
-                    time.sleep(self._REFRESH_TIMEOUT)
-                    self.send(address="/meters", param=["/meters/2"])
-                if self.state.clip: # seems to crash if clipping protection runs for more than one cycle
-                    if self.state.debug:
-                        print("start auto level")
-                    self.state.clip = False
-#                    if self.state.screen_obj is not None:
-#                        self.state.screen_obj.gpio_button[1].disable[0] = 1
-                time.sleep(self._REFRESH_TIMEOUT)
-                if self.state.quit_called:
-                    self.quit()
-                    return
-        except KeyboardInterrupt:
-            self.quit()
-        except socket.error:
-            self.quit()
+            confirmed = await self.sync.run()
+        finally:
+            # stops the retry timer if the sync was cancelled
+            self.sync.finish()
+            failed = self.sync.failed
+            self.sync = None
+        if failed:
+            print('Warning: no reply from mixer for %d parameters, e.g. %s' %
+                  (len(failed), failed[0]))
+        return confirmed
 
     def send(self, address, param=None):
         "Call the OSC agent to send a message"
+        if self.coalesced:
+            # a direct send supersedes a pending coalesced value
+            self.coalesced.pop(address, None)
         self.server.send_message(address, param)
 
-def find_mixer():
-    "Search for the IP address of the XAir mixer"
+    def send_coalesced(self, address, param):
+        """
+        Queue a set message until the next coalesce tick, a later value for the
+        same address replaces the queued one so only the final value is sent.
+        """
+        if self.state.coalesce <= 0:
+            self.send(address, param)
+            return
+        self.coalesce_queued += 1
+        loop = asyncio.get_running_loop()
+        entry = self.coalesced.get(address)
+        if entry is None:
+            self.coalesced[address] = [param, loop.time()]
+        else:
+            entry[0] = param
+        if self.coalesce_handle is None:
+            self.coalesce_handle = loop.call_later(self.state.coalesce, self.flush_coalesced)
+
+    def flush_coalesced(self):
+        "Timer callback that sends the final value of every queued address."
+        self.coalesce_handle = None
+        if self.server is None:
+            self.coalesced.clear()
+            return
+        now = asyncio.get_running_loop().time()
+        for address, (param, queued) in self.coalesced.items():
+            self.server.send_message(address, param)
+            self.coalesce_sent += 1
+            self.coalesce_latency += now - queued
+            self.coalesce_max_latency = max(self.coalesce_max_latency, now - queued)
+        self.coalesced.clear()
+
+    def coalesce_stats(self):
+        "Summary of the packets saved and latency added by coalescing."
+        if self.coalesce_sent == 0:
+            return 'coalesce: no packets'
+        return 'coalesce: %d sets queued, %d sent, %d saved, latency avg %0.1fms max %0.1fms' % \
+            (self.coalesce_queued, self.coalesce_sent, self.coalesce_queued - self.coalesce_sent,
+             self.coalesce_latency / self.coalesce_sent * 1000, self.coalesce_max_latency * 1000)
+
+def find_mixers(last_address=None, timeout=1.0, settle=0.2):
+    """
+    Search for XAir mixers. The last known address is probed directly and
+    /xinfo is broadcast on every interface at the same time. Returns as soon as
+    the last known mixer answers, otherwise collects the replies until settle
+    seconds after the first one or timeout. The list of (address, info) is
+    ranked with the last known mixer first, then by IP address.
+    """
     print('Searching for mixer...')
-    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-    client.settimeout(5)
-    for iface in netifaces.interfaces():
-        try:
-            bcast = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['broadcast']
-            client.sendto("/xinfo\0\0".encode(), (bcast, XAirClient.XAIR_PORT))
-        except:
-            pass
-    try:
-        response = OscMessage(client.recv(512))
-    except socket.timeout:
+    probe = "/xinfo\0\0".encode()
+    last = None
+    if last_address:
+        host, _, port = last_address.partition(':')
+        last = (host, int(port) if port else XAirClient.XAIR_PORT)
+    found = {}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as client:
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+        if last is not None:
+            try:
+                client.sendto(probe, last)
+            except OSError:
+                last = None
+        for iface in netifaces.interfaces():
+            try:
+                bcast = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['broadcast']
+                client.sendto(probe, (bcast, XAirClient.XAIR_PORT))
+            except (KeyError, IndexError, OSError):
+                pass
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            client.settimeout(remaining)
+            try:
+                data, source = client.recvfrom(512)
+            except socket.timeout:
+                break
+            except OSError:
+                # e.g. the last known address is unreachable
+                continue
+            try:
+                response = OscMessage(data)
+            except MessageParseError:
+                continue
+            if response.address != '/xinfo' or len(response.params) < 4:
+                continue
+            found[source] = response.params
+            if source == last:
+                break
+            deadline = min(deadline, time.monotonic() + settle)
+    if not found:
         print('No server found')
-        return None
-    client.close()
-
-    if response.address != '/xinfo':
-        print('Unknown response')
-        return None
-    else:
-        print('Found ' + response.params[2] + ' with firmware ' + response.params[3] + ' on IP ' + response.params[0])
-        return response.params[0]
+        return []
+    ranked = sorted(found, key=lambda source: (source != last, socket.inet_aton(source[0]),
+                                               source[1]))
+    mixers = []
+    for source in ranked:
+        info = found[source]
+        address = source[0] if source[1] == XAirClient.XAIR_PORT else '%s:%d' % source
+        print('Found ' + info[2] + ' ' + info[1] + ' with firmware ' + info[3] + ' on IP ' +
+              address)
+        mixers.append((address, info))
+    return mixers
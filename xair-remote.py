@@ -7,7 +7,9 @@
 # Some rights reserved. See LICENSE.
 
 import argparse
+import asyncio
 from lib.mixerstate import MixerState
+from lib.snapshot import default_directory
 
 if __name__ == '__main__':
     PARSER = argparse.ArgumentParser(description="""
@@ -29,18 +31,53 @@ if __name__ == '__main__':
     Layer B - Aux Bus 1-6 output levels, USB IN Gain, Main/LR Bus output level.
     """,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
-    PARSER.add_argument('xair_address', help='ip address of your X-Air mixer (optional)', nargs='?')
+    PARSER.add_argument('xair_address', help='ip address[:port] of your X-Air mixer (optional)', nargs='?')
     PARSER.add_argument('-m', '--monitor',
-                        help='monitor X-Touch connection and exit when disconnected',
+                        help='monitor X-Touch connection and reattach when it is plugged in again',
                         action="store_true")
     PARSER.add_argument('-d', '--debug', help='enable debug output', action="store_true")
     PARSER.add_argument('-l', '--levels', help='get levels from the mixer', action="store_true")
     PARSER.add_argument('-c', '--clip', help='enabling auto leveling to avoid clipping',
                         action="store_true")
+    PARSER.add_argument('--clip-threshold', help='input level in dB that lowers the gain \
+                        (default %(default)s)', type=float, default=-3.0, metavar='DB')
+    PARSER.add_argument('--clip-attack', help='seconds above the threshold before each gain \
+                        step (default %(default)s)', type=float, default=0.1, metavar='SECONDS')
+    PARSER.add_argument('--clip-release', help='seconds after a change before a quiet input \
+                        gets a gain step back (default %(default)s)', type=float, default=5.0,
+                        metavar='SECONDS')
+    PARSER.add_argument('--clip-step', help='gain step in dB (default %(default)s)',
+                        type=float, default=1.0, metavar='DB')
+    PARSER.add_argument('--clip-inputs', help='headamps to protect, e.g. 1-8,13-16 \
+                        (default %(default)s)', default='1-16', metavar='LIST')
     PARSER.add_argument('-f', '--config_file', help="JSON formated config file", nargs=1)
+    PARSER.add_argument('-L', '--layer', help='start layer of the next connected X-Touch Mini \
+                        in port order, repeat for each surface (default the first layer)',
+                        dest='layers', action='append', metavar='LAYER')
+    PARSER.add_argument('-M', '--mixer', help='another mixer the config can use as \
+                        NAME:/channel, repeat for each mixer', dest='mixers', action='append',
+                        metavar='NAME=ADDRESS')
+    PARSER.add_argument('--config-cache', help='keep the compiled config next to the JSON \
+                        file and reuse it while the file is unchanged', action="store_true")
+    PARSER.add_argument('-t', '--coalesce', help='milliseconds to collect encoder turns before \
+                        sending the final level to the mixer, 0 sends every turn (default 5)',
+                        type=float, default=5.0)
+    PARSER.add_argument('--metrics', help="collect hot path metrics and write them to FILE \
+                        ('-' for stdout) periodically and on SIGUSR1", metavar='FILE')
+    PARSER.add_argument('--metrics-interval', help='seconds between metrics dumps (default 60, \
+                        0 only dumps on signal and exit)', type=float, default=60.0)
+    PARSER.add_argument('--profile', help='toggle cProfile with SIGUSR2 and write the stats \
+                        to FILE', metavar='FILE')
+    PARSER.add_argument('--snapshot-dir', help='directory of the mixer state snapshots used \
+                        for a warm start and of the last found mixer address \
+                        (default %(default)s)', metavar='DIR',
+                        default=default_directory())
+    PARSER.add_argument('--no-snapshot', help='always read the full mixer state at startup',
+                        dest='snapshot_dir', action='store_const', const=None)
     ARGS = PARSER.parse_args()
 
     STATE = MixerState(ARGS)
-    if STATE.initialize_state():
-        # now start polling refresh /xremote command while running
-        STATE.xair_client.refresh_connection()
+    try:
+        asyncio.run(STATE.run())
+    except KeyboardInterrupt:
+        pass
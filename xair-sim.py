@@ -0,0 +1,50 @@
+"Starts a simulated X-Air mixer, see main help string for more"
+#!/usr/bin/env python3
+
+# part of xair-remote.py
+# Copyright (c) 2018, 2021 Peter Dikant
+# Additions Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import argparse
+import asyncio
+from lib.simulator import MixerSimulator, start_simulator
+
+async def run(args):
+    "Serve until interrupted."
+    transport, _ = await start_simulator(args.address, args.port, name=args.name,
+                                         model=args.model, latency=args.latency / 1000,
+                                         loss=args.loss, signal=args.signal, seed=args.seed,
+                                         debug=args.debug)
+    print('Simulating %s %s on %s:%d' % (args.model, args.name, args.address, args.port))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description="""
+    Simulate an X-Air mixer on the local network to run xair-remote without
+    hardware. The simulator answers /xinfo (also to broadcast discovery),
+    stores the parameters set by clients, pushes changes to /xremote clients
+    and sends /meters data every 50ms.
+    """)
+    PARSER.add_argument('-a', '--address', help='address to listen on (default all)',
+                        default='0.0.0.0')
+    PARSER.add_argument('-p', '--port', help='UDP port (default 10024)', type=int, default=10024)
+    PARSER.add_argument('-n', '--name', help='mixer name reported by /xinfo', default='XR18-SIM')
+    PARSER.add_argument('-m', '--model', help='mixer model reported by /xinfo', default='XR18')
+    PARSER.add_argument('-l', '--latency', help='added one way latency in ms', type=float,
+                        default=0.0)
+    PARSER.add_argument('-x', '--loss', help='fraction of datagrams lost each way', type=float,
+                        default=0.0)
+    PARSER.add_argument('-s', '--signal', help='meter signal model', choices=MixerSimulator.SIGNALS,
+                        default='sine')
+    PARSER.add_argument('--seed', help='random seed for noise and loss', type=int)
+    PARSER.add_argument('-d', '--debug', help='print every received message', action="store_true")
+    ARGS = PARSER.parse_args()
+
+    try:
+        asyncio.run(run(ARGS))
+    except KeyboardInterrupt:
+        pass